@@ -0,0 +1,29 @@
+"""
+Per-call latency of wgr_regress: the Cholesky fast path against the
+pivoted-QR path it falls back to, on the thin designs of the estimators
+
+Usage: python wgr_regress.py [n_calls]
+"""
+import sys
+import timeit
+import numpy as np
+from rsHRF.sFIR import smooth_fir
+
+def main(n_calls=2000):
+    rng = np.random.RandomState(0)
+    print('%6s %6s %12s %12s %8s' % ('nobs', 'ncol', 'QR (us)', 'chol (us)', 'speedup'))
+    for nobs in [150, 1200]:
+        for ncol in [1, 2, 4, 8]:
+            X = rng.randn(nobs, ncol)
+            y = rng.randn(nobs)
+            assert np.allclose(smooth_fir.wgr_regress(y, X),
+                               smooth_fir._wgr_regress_qr(y, X))
+            t_qr = min(timeit.repeat(lambda: smooth_fir._wgr_regress_qr(y, X),
+                                     number=n_calls, repeat=3)) / n_calls
+            t_chol = min(timeit.repeat(lambda: smooth_fir.wgr_regress(y, X),
+                                       number=n_calls, repeat=3)) / n_calls
+            print('%6d %6d %12.1f %12.1f %7.1fx' % (nobs, ncol, t_qr * 1e6,
+                                                    t_chol * 1e6, t_qr / t_chol))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
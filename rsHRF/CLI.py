@@ -3,7 +3,6 @@ import numpy   as np
 import os.path as op
 import json
 from argparse      import ArgumentParser
-from bids.layout import BIDSLayout
 from pathlib import Path
 from rsHRF      import spm_dep, fourD_rsHRF, utils
 
@@ -38,7 +37,52 @@ def get_parser():
                         help='the output path for the outcomes of processing')
 
     parser.add_argument('--n_jobs', action='store', type=int, default=-1,
-                        help='the number of parallel processing elements')
+                        help='the number of parallel processing elements; with --bids_dir, '
+                             'shared between the runs processed concurrently and the voxel '
+                             'workers of each run')
+
+    parser.add_argument('--run_jobs', action='store', type=int,
+                        help='with --bids_dir, the number of runs processed concurrently '
+                             '(default: as many as --n_jobs and --max_memory allow)')
+
+    parser.add_argument('--max_memory', action='store', type=float,
+                        help='with --bids_dir, the memory (GB) the runs processed concurrently '
+                             'may use together, from the estimate of each run\'s voxel and '
+                             'volume counts (default: the memory available at start)')
+
+    parser.add_argument('--backend', action='store', default='processes',
+                        choices=['processes', 'threads', 'serial'],
+                        help='how the voxels are processed in parallel: worker processes '
+                             'sharing memory-mapped data (default), threads sharing the data '
+                             'in memory, or serially')
+
+    parser.add_argument('--slab_size', action='store', type=int,
+                        help='stream NIfTI inputs through the analysis in slabs of at most '
+                             'this many voxels (all time points) instead of loading the whole '
+                             '4D image, to lower the peak memory')
+
+    parser.add_argument('--dtype', action='store', default='float64',
+                        choices=['float64', 'float32'],
+                        help='precision of the BOLD signals and of the output volumes; '
+                             'float32 halves the memory (the HRF fits are always done '
+                             'in double precision)')
+
+    parser.add_argument('--deconv_dtype', action='store',
+                        choices=['float64', 'float32', 'int16'],
+                        help='data type of the deconvolved BOLD image (default: --dtype); '
+                             'int16 is stored with a scale factor')
+
+    parser.add_argument('--output_format', action='store', default='mat',
+                        choices=['mat', 'hdf5', 'zarr', 'npz'],
+                        help='format of the HRF results of each run: MATLAB .mat (default), '
+                             'or compressed HDF5 (needs h5py), Zarr (needs zarr<3) or .npz, '
+                             'with the events stored as (event_indices, event_offsets) and '
+                             'per-voxel access (see rsHRF.utils.result_store.load_results)')
+
+    parser.add_argument('--cache_dir', action='store', type=op.abspath,
+                        help='directory for data reused across runs and invocations '
+                             '(e.g. the basis sets of the estimation parameters, and the '
+                             'index of --bids_dir, rebuilt when the dataset changes)')
 
     parser.add_argument('-V', '--version', action='version', version='rsHRF version {}'.format(__version__))
 
@@ -206,7 +250,7 @@ def run_rsHRF():
         para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
                                 np.fix(para['max_onset_search'] / para['dt']) + 1,
                                 dtype='int')
-        fourD_rsHRF.demo_rsHRF(args.ts, None, args.output_dir, para, args.n_jobs, file_type, mode='time-series', temporal_mask=temporal_mask, wiener=args.wiener)
+        fourD_rsHRF.demo_rsHRF(args.ts, None, args.output_dir, para, args.n_jobs, file_type, mode='time-series', temporal_mask=temporal_mask, wiener=args.wiener, backend=args.backend, slab_size=args.slab_size, dtype=args.dtype, cache_dir=args.cache_dir, deconv_dtype=args.deconv_dtype, output_format=args.output_format)
 
     if args.input_file is not None:
         if args.atlas is not None:
@@ -239,7 +283,7 @@ def run_rsHRF():
         para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
                                 np.fix(para['max_onset_search'] / para['dt']) + 1,
                                 dtype='int')
-        fourD_rsHRF.demo_rsHRF(args.input_file, args.atlas, args.output_dir, para, args.n_jobs, file_type, mode='input', temporal_mask=temporal_mask, wiener=args.wiener)
+        fourD_rsHRF.demo_rsHRF(args.input_file, args.atlas, args.output_dir, para, args.n_jobs, file_type, mode='input', temporal_mask=temporal_mask, wiener=args.wiener, backend=args.backend, slab_size=args.slab_size, dtype=args.dtype, cache_dir=args.cache_dir, deconv_dtype=args.deconv_dtype, output_format=args.output_format)
 
     if args.bids_dir is not None:
         utils.bids.write_derivative_description(args.bids_dir, args.output_dir)
@@ -266,7 +310,7 @@ def run_rsHRF():
         
     if args.bids_dir is not None and args.atlas is not None:
         # carry analysis with bids_dir and 1 atlas
-        layout = BIDSLayout(args.bids_dir, validate=False, config =['bids', 'derivatives'])
+        layout = utils.bids.bids_layout(args.bids_dir, args.cache_dir, validate=False, config =['bids', 'derivatives'])
         
         if args.participant_label:
             input_subjects = args.participant_label
@@ -303,33 +347,26 @@ def run_rsHRF():
                          'Please make sure to have at least one file of the above type '
                          'in the BIDS specification')
         else:
-            num_errors = 0
+            runs = []
             for file_count in range(len(all_inputs)):
+                file_type = all_inputs[file_count].split('bold')[1]
                 try:
                     TR = layout.get_metadata(all_inputs[file_count])['RepetitionTime']
                 except KeyError as e:
                     TR = spm_dep.spm.spm_vol(all_inputs[file_count]).header.get_zooms()[-1]
-                para['TR'] = TR
-                para['dt'] = para['TR'] / para['T']
-                para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
-                                        np.fix(para['max_onset_search'] / para['dt']) + 1,
-                                        dtype='int')
-                num_errors += 1
-                try:
-                    fourD_rsHRF.demo_rsHRF(all_inputs[file_count], args.atlas, args.output_dir, para, args.n_jobs, file_type, mode='bids w/ atlas', temporal_mask=temporal_mask, wiener=args.wiener)
-                    num_errors -=1
-                except ValueError as err:
-                    print(err.args[0])
-                except:
-                    print("Unexpected error:", sys.exc_info()[0])
-            success = len(all_inputs) - num_errors
-            if success == 0:
-                raise RuntimeError('Dimensions were inconsistent for all input-mask pairs; \n'
-                                   'No inputs were processed!')
+                run_para = dict(para)
+                run_para['TR'] = TR
+                run_para['dt'] = run_para['TR'] / run_para['T']
+                run_para['lag'] = np.arange(np.fix(run_para['min_onset_search'] / run_para['dt']),
+                                            np.fix(run_para['max_onset_search'] / run_para['dt']) + 1,
+                                            dtype='int')
+                runs.append(((all_inputs[file_count], args.atlas, args.output_dir, run_para),
+                             dict(file_type=file_type, mode='bids w/ atlas')))
+            run_bids(runs, args, temporal_mask)
 
     if args.bids_dir is not None and args.brainmask:
         # carry analysis with bids_dir and brainmask
-        layout = BIDSLayout(args.bids_dir, validate=False, config =['bids', 'derivatives'])
+        layout = utils.bids.bids_layout(args.bids_dir, args.cache_dir, validate=False, config =['bids', 'derivatives'])
 
         if args.participant_label:
             input_subjects = args.participant_label
@@ -403,37 +440,67 @@ def run_rsHRF():
             parser.error('The mask and input files should have the same prefix for correspondence. '
                          'Please consider renaming your files')
         else:
-            num_errors = 0
+            runs = []
             for file_count in range(len(all_inputs)):
                 file_type = all_inputs[file_count].split('bold')[1]
+                run_para = dict(para)
                 if file_type == ".nii" or file_type == ".nii.gz":
                     try:
                         TR = layout.get_metadata(all_inputs[file_count])['RepetitionTime']
                     except KeyError as e:
                         TR = spm_dep.spm.spm_vol(all_inputs[file_count]).header.get_zooms()[-1]
-                    para['TR'] = TR
+                    run_para['TR'] = TR
                 else:
                     spm_dep.spm.spm_vol(all_inputs[file_count])
                     TR = spm_dep.spm.spm_vol(all_inputs[file_count]).get_arrays_from_intent("NIFTI_INTENT_TIME_SERIES")[0].meta.get_metadata()["TimeStep"]
-                    para['TR'] = float(TR) * 0.001
-
-
-                para['dt'] = para['TR'] / para['T']
-                para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
-                                        np.fix(para['max_onset_search'] / para['dt']) + 1,
-                                        dtype='int')
-                num_errors += 1
-                try:
-                    fourD_rsHRF.demo_rsHRF(all_inputs[file_count], all_masks[file_count], args.output_dir, para, args.n_jobs, mode='bids', temporal_mask=temporal_mask, wiener=args.wiener)
-                    num_errors -=1
-                except ValueError as err:
-                    print(err.args[0])
-                except:
-                    print("Unexpected error:", sys.exc_info()[0])
-            success = len(all_inputs) - num_errors
-            if success == 0:
-                raise RuntimeError('Dimensions were inconsistent for all input-mask pairs; \n'
-                                   'No inputs were processed!')
+                    run_para['TR'] = float(TR) * 0.001
+
+
+                run_para['dt'] = run_para['TR'] / run_para['T']
+                run_para['lag'] = np.arange(np.fix(run_para['min_onset_search'] / run_para['dt']),
+                                            np.fix(run_para['max_onset_search'] / run_para['dt']) + 1,
+                                            dtype='int')
+                runs.append(((all_inputs[file_count], all_masks[file_count], args.output_dir, run_para),
+                             dict(mode='bids')))
+            run_bids(runs, args, temporal_mask)
+
+
+def run_bids(runs, args, temporal_mask):
+    """
+    Runs demo_rsHRF on the (input, mask, output_dir, para) of each BIDS run,
+    several runs at a time: --n_jobs is split between the runs processed
+    concurrently and the voxel workers of each run, and runs are started
+    only while their estimated memory fits in --max_memory. A failing run
+    is reported and does not stop the others.
+    """
+    run_jobs, voxel_jobs = utils.scheduler.split_jobs(len(runs), args.n_jobs, args.run_jobs)
+    max_memory = utils.scheduler.available_memory() if args.max_memory is None \
+                 else args.max_memory * 2 ** 30
+    output_paths = utils.bids.BIDSOutputPaths(args.output_dir)
+    memory = [0] * len(runs)
+    if run_jobs > 1:
+        for i, (arg, kwargs) in enumerate(runs):
+            try:
+                memory[i] = utils.scheduler.run_memory(arg[0], arg[1], args.dtype, args.slab_size)
+            except Exception:
+                # unreadable runs are admitted as is, and fail in isolation
+                pass
+    for arg, kwargs in runs:
+        kwargs.update(temporal_mask=temporal_mask, wiener=args.wiener, backend=args.backend,
+                      slab_size=args.slab_size, dtype=args.dtype, cache_dir=args.cache_dir,
+                      deconv_dtype=args.deconv_dtype, output_format=args.output_format,
+                      output_paths=output_paths)
+    runs = [(arg + (voxel_jobs,), kwargs) for arg, kwargs in runs]
+    print('Processing {0} runs, {1} at a time with {2} voxel workers each'.format(
+          len(runs), run_jobs, voxel_jobs))
+    _, errors = utils.scheduler.map_runs(fourD_rsHRF.demo_rsHRF, runs, run_jobs, memory,
+                                         max_memory, voxel_jobs)
+    for i, message in errors:
+        print('Failed: ' + runs[i][0][0] + '\n\t' + message)
+    if len(errors) == len(runs):
+        raise RuntimeError('Dimensions were inconsistent for all input-mask pairs; \n'
+                           'No inputs were processed!')
+    print('Processed {0} of {1} runs'.format(len(runs) - len(errors), len(runs)))
 
 
 
@@ -1,4 +1,7 @@
+import os
 import math
+import hashlib
+import tempfile
 import numpy as np
 from scipy.stats import gamma
 from rsHRF import canon, spm_dep, sFIR
@@ -10,7 +13,84 @@ warnings.filterwarnings("ignore")
 BASIS FUNCTION COMPUTATION
 """
 
-def get_basis_function(bold_sig_shape, para):
+# orthogonalized basis sets of this process, by basis_key
+_BASIS_CACHE = {}
+
+# phase-shifted basis sets of this process, by basis set and T
+_PHASES_CACHE = {}
+
+def basis_key(para):
+    """
+    The estimation parameters the basis set depends on
+    """
+    return (para['estimation'], float(para['TR']), int(para['T']), float(para['dt']),
+            float(para['len']), int(para.get('order', 0)), int(para.get('TD_DD', 0)),
+            int(para.get('Volterra', 1)))
+
+def get_basis_function(bold_sig_shape, para, cache_dir=None):
+    """
+    Orthogonalized basis set (len/dt x nbf), cached in-process and, with
+    cache_dir, on disk (shared by runs and processes with the same
+    estimation parameters); the returned array is read-only
+    """
+    key = basis_key(para)
+    bf = _BASIS_CACHE.get(key)
+    fname = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        fname = os.path.join(cache_dir, 'rsHRF_basis_' + digest + '.npy')
+    if bf is not None:
+        # computed earlier in this process, possibly without cache_dir
+        if fname is not None and not os.path.isfile(fname):
+            _save_basis(fname, bf)
+        return bf
+    if fname is not None and os.path.isfile(fname):
+        bf = np.load(fname)
+    if bf is None:
+        bf = compute_basis_function(bold_sig_shape, para)
+        if fname is not None:
+            _save_basis(fname, bf)
+    bf.flags.writeable = False
+    _BASIS_CACHE[key] = bf
+    return bf
+
+def _save_basis(fname, bf):
+    cache_dir = os.path.dirname(fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written aside and renamed, for concurrent runs
+    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, bf)
+    os.replace(tmp, fname)
+
+def get_basis_phases(bf, T):
+    """
+    wgr_basis_phases(bf, T), cached in-process by the (final) basis set
+    and T; the returned array is read-only
+    """
+    bf = np.asarray(bf)
+    key = (bf.shape, bf.dtype.str, hashlib.sha1(np.ascontiguousarray(bf).tobytes()).hexdigest(), int(T))
+    phases = _PHASES_CACHE.get(key)
+    if phases is None:
+        phases = wgr_basis_phases(bf, int(T))
+        phases.flags.writeable = False
+        _PHASES_CACHE[key] = phases
+    return phases
+
+def wgr_basis_phases(bf, T):
+    """
+    The basis set resampled at the acquisition times for each of the T
+    microtime phases of an onset: phases[r, m] = bf[r + m*T] (zero past
+    the end of bf), as used by the onset designs of every lag
+    Returns (T x ceil(len/T)+1 x nbf)
+    """
+    L, nbf = bf.shape
+    M = -(-L // T) + 1
+    phases = np.zeros((M * T, nbf))
+    phases[:L] = bf
+    return phases.reshape((M, T, nbf)).transpose((1, 0, 2))
+
+def compute_basis_function(bold_sig_shape, para):
     N, nvar = bold_sig_shape
     dt = para['dt'] # 'time bin for basis functions {secs}';
     l  = para['len']
@@ -1,11 +1,11 @@
 import os
+import time
+import functools
 import matplotlib
 matplotlib.use('agg')
 import numpy             as np
 import nibabel           as nib
-import scipy.io          as sio
 import matplotlib.pyplot as plt
-from bids.layout  import BIDSLayout, parse_file_entities 
 from scipy        import stats, signal
 from scipy.sparse import lil_matrix
 from rsHRF        import spm_dep, processing, parameters, basis_functions, utils, iterative_wiener_deconv
@@ -13,7 +13,10 @@ from rsHRF        import spm_dep, processing, parameters, basis_functions, utils
 import warnings
 warnings.filterwarnings("ignore")
 
-def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii", mode="bids", wiener=False, temporal_mask=[]):
+STAGES = ['HRF estimation', 'HRF parameters', 'deconvolution']
+
+def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii", mode="bids", wiener=False, temporal_mask=[], backend='processes', slab_size=None, dtype=np.float64, progress=None, cache_dir=None,
+               deconv_dtype=None, output_format='mat', output_paths=None):
     # book-keeping w.r.t parameter values
     if 'localK' not in para or para['localK'] == None:
         if para['TR']<=2:
@@ -23,6 +26,13 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
     # creating the output-directory if not already present
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
+    # precision of the BOLD signals and of the output volumes (float64 or float32)
+    dtype = np.dtype(dtype)
+    # data type of the deconvolved image (integer types are stored scaled)
+    deconv_dtype = dtype if deconv_dtype is None else np.dtype(deconv_dtype)
+    # NIfTI input can be streamed in slabs of slab_size voxels instead of being loaded whole
+    stream = bool(slab_size) and mode != 'time-series' and \
+             (file_type == ".nii" or file_type == ".nii.gz")
     # for four-dimensional input
     if mode != 'time-series':
         if mode == 'bids' or mode == 'bids w/ atlas':
@@ -39,7 +49,7 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
                 mask_name = mask_file.split('/')[-1].split('.')[0]
                 v = spm_dep.spm.spm_vol(mask_file)
             if file_type == ".nii" or file_type == ".nii.gz":
-                brain = spm_dep.spm.spm_read_vols(v)
+                brain = spm_dep.spm.spm_read_vols(v, dtype)
             else:
                 brain = v.agg_data().flatten(order='F')
             if  ((file_type == ".nii" or file_type == ".nii.gz") and \
@@ -47,25 +57,38 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
                 ((file_type == ".gii" or file_type == ".gii.gz") and \
                     v1.agg_data().shape[0]!= v.agg_data().shape[0]):
                 raise ValueError ('Inconsistency in input-mask dimensions' + '\n\tinput_file == ' + name + file_type + '\n\tmask_file == ' + mask_name + file_type)
-            else:
+            elif not stream:
                 if file_type == ".nii" or file_type == ".nii.gz" :
-                    data   = v1.get_data()      
+                    # read (and scaled) straight to dtype: no float64 copy in float32 mode
+                    data   = v1.get_fdata(dtype=dtype, caching='unchanged')
                 else:
                     data   = v1.agg_data()
         else:
             print('No atlas provided! Generating mask file...')
-            if file_type == ".nii" or file_type == ".nii.gz" :
-                data   = v1.get_data() 
-                brain  = np.nanvar(data.reshape(-1, data.shape[3]), -1, ddof=0)
+            if stream:
+                brain  = np.concatenate([np.nanvar(read_slab(v1, z0, z1), 0, ddof=0)
+                                         for z0, z1 in slab_bounds(v1.shape[:-1], slab_size)])
+            elif file_type == ".nii" or file_type == ".nii.gz" :
+                data   = v1.get_fdata(dtype=dtype, caching='unchanged')
+                brain  = np.nanvar(data.reshape((-1, data.shape[3]), order='F'), -1, ddof=0)
             else:
                 data   = v1.agg_data()
                 brain  = np.nanvar(data, -1, ddof=0) 
             print('Done')
         voxel_ind  = np.where(brain > 0)[0]
-        mask_shape = data.shape[:-1]
-        nobs       = data.shape[-1]
-        data1      = np.reshape(data, (-1, nobs), order='F').T
-        bold_sig = stats.zscore(data1[:, voxel_ind], ddof=1)
+        if stream:
+            mask_shape = v1.shape[:-1]
+            nobs       = v1.shape[-1]
+        else:
+            mask_shape = data.shape[:-1]
+            nobs       = data.shape[-1]
+        # packs / unpacks the masked voxels of the input and output images
+        codec = utils.masked_volume.MaskedVolume(voxel_ind, mask_shape, getattr(v1, 'affine', None))
+        if not stream:
+            bold_sig = codec.pack(data).astype(dtype, copy=False)
+            # the image is no longer needed: only the masked signals are kept
+            del data
+            bold_sig = stats.zscore(bold_sig, ddof=1)
    # for time-series input
     else:
         name = input_file.split('/')[-1].split('.')[0]
@@ -73,119 +96,123 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
         if data1.ndim == 1:
             data1 = np.expand_dims(data1, axis=1)
         nobs = data1.shape[0]
-        bold_sig = stats.zscore(data1, ddof=1)
+        bold_sig = stats.zscore(data1.astype(dtype), ddof=1)
     if len(temporal_mask) > 0 and len(temporal_mask) != nobs:
             raise ValueError ('Inconsistency in temporal_mask dimensions.\n' + 'Size of mask: ' + str(len(temporal_mask)) + '\n' + 'Size of time-series: ' + str(nobs))
-    bold_sig = np.nan_to_num(bold_sig)
-    bold_sig_deconv = processing. \
-                      rest_filter. \
-                      rest_IdealFilter(bold_sig, para['TR'], para['passband_deconvolve'])   
-    bold_sig = processing. \
-               rest_filter. \
-               rest_IdealFilter(bold_sig, para['TR'], para['passband'])   
-    data_deconv  = np.zeros(bold_sig.shape)
-    event_number = np.zeros((1, bold_sig.shape[1]))
-    print('Retrieving HRF ...')
-    #Estimate HRF for the fourier / hanning / gamma / cannon basis functions
+    # setting the output-path
+    if mode == 'bids' or mode == 'bids w/ atlas':
+        # output paths builder, shared by the runs of an invocation
+        if output_paths is None:
+            output_paths = utils.bids.BIDSOutputPaths(output_dir)
+        sub_save_dir = output_paths.run_dir(input_file)
+    else:
+        sub_save_dir = output_dir
+    if not os.path.isdir(sub_save_dir):
+        os.makedirs(sub_save_dir, exist_ok=True)
+    #Basis functions for the fourier / hanning / gamma / cannon estimation, none for FIR and sFIR
     if not (para['estimation'] == 'sFIR' or para['estimation'] == 'FIR'):
-        bf = basis_functions.basis_functions.get_basis_function(bold_sig.shape, para)
-        beta_hrf, event_bold = utils.hrf_estimation.compute_hrf(bold_sig, para, temporal_mask, p_jobs, bf=bf)
-        hrfa = np.dot(bf, beta_hrf[np.arange(0, bf.shape[1]), :])
-    #Estimate HRF for FIR and sFIR
+        bf = basis_functions.basis_functions.get_basis_function((nobs, 1), para, cache_dir)
     else:
         para['T'] = 1        
-        beta_hrf, event_bold = utils.hrf_estimation.compute_hrf(bold_sig, para, temporal_mask, p_jobs)
-        hrfa = beta_hrf[:-1,:]
-    nvar = hrfa.shape[1]
-    PARA = np.zeros((3, nvar))
-    for voxel_id in range(nvar):
-        hrf1 = hrfa[:, voxel_id]
-        PARA[:, voxel_id] = \
-            parameters.wgr_get_parameters(hrf1, para['TR'] / para['T'])
-    print('Done')
-    print('Deconvolving HRF ...')
-    if para['T'] > 1:
-        hrfa_TR = signal.resample_poly(hrfa, 1, para['T'])
+        bf = None
+    # seconds spent in each stage, and progress(stage, done, nvar) of each stage
+    timing = dict.fromkeys(STAGES, 0.)
+    if not stream:
+        print('Retrieving HRF and deconvolving ...')
+        bold_sig, hrfa, hrfa_TR, event_bold, PARA, data_deconv = \
+            hrf_stages(bold_sig, para, temporal_mask, p_jobs, bf, wiener, backend, progress, timing)
+        print('Done')
     else:
-        hrfa_TR = hrfa
-    for voxel_id in range(nvar):
-        hrf = hrfa_TR[:, voxel_id]
-        if not wiener:
-            H = np.fft.fft(
-                np.append(hrf,
-                          np.zeros((nobs - max(hrf.shape), 1))), axis=0)
-            M = np.fft.fft(bold_sig_deconv[:, voxel_id])
-            data_deconv[:, voxel_id] = \
-                np.fft.ifft(H.conj() * M / (H * H.conj() + .1*np.mean((H * H.conj()))))
+        # the deconvolved image is written slab by slab into a memory-mapped
+        # volume: the output image itself when it is an uncompressed,
+        # unscaled NIfTI, a temporary file streamed to the output otherwise
+        deconv_direct = file_type == ".nii" and deconv_dtype == dtype
+        if deconv_direct:
+            deconv_name = os.path.join(sub_save_dir, name.rsplit('_bold', 1)[0] + '_deconv')
+            deconv_vol = spm_dep.spm.spm_create_vol(v1, mask_shape + (nobs,), deconv_name, dtype)
         else:
-            # Use new API with MATLAB v2.5 features (auto-recommendations based on TR and Mode)
-            # Default to 'rest' mode for resting-state fMRI (can be overridden in para dict)
-            deconv_mode = para.get('deconv_mode', 'rest')
-            data_deconv[:, voxel_id] = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv(
-                bold_sig_deconv[:, voxel_id],
-                hrf,
-                TR=para['TR'],
-                MaxIter=para.get('deconv_MaxIter', 50),
-                Tol=para.get('deconv_Tol', 1e-4),
-                Mode=deconv_mode
-            )
+            deconv_file = os.path.join(sub_save_dir, name + '_deconv.dat')
+            deconv_vol = np.memmap(deconv_file, dtype=dtype, mode='w+',
+                                   shape=mask_shape + (nobs,), order='F')
+        deconv_vox = deconv_vol.reshape((-1, nobs), order='F')
+        deconv_max = 0.
+        plane = int(np.prod(mask_shape[:-1]))
+        bounds = slab_bounds(mask_shape, slab_size)
+        hrfa, event_bold, PARA, plot_sig = [], [], [], None
+        for k, (z0, z1) in enumerate(bounds):
+            ind = voxel_ind[(voxel_ind >= z0 * plane) & (voxel_ind < z1 * plane)]
+            if ind.size == 0:
+                continue
+            print('Retrieving HRF and deconvolving (slab {0}/{1}) ...'.format(k + 1, len(bounds)))
+            bold_sig = stats.zscore(read_slab(v1, z0, z1)[:, ind - z0 * plane].astype(dtype), ddof=1)
+            bold_sig, hrfa_k, hrfa_TR, event_bold_k, PARA_k, data_deconv = \
+                hrf_stages(bold_sig, para, temporal_mask, p_jobs, bf, wiener, backend, progress, timing)
+            deconv_vox[ind, :] = data_deconv.T
+            deconv_max = np.nanmax([deconv_max, np.nanmax(np.abs(data_deconv))])
+            if plot_sig is None and np.any(hrfa_TR):
+                plot_sig = bold_sig[:, np.where(np.any(hrfa_TR, axis=0))[0][0]].copy()
+            hrfa.append(hrfa_k)
+            event_bold.append(event_bold_k)
+            PARA.append(PARA_k)
+        print('Done')
+        hrfa = np.concatenate(hrfa, axis=1)
+        event_bold = np.concatenate(event_bold)
+        PARA = np.concatenate(PARA, axis=1)
+        hrfa_TR = hrf_at_TR(hrfa, para)
+    print('Time spent: ' + ', '.join('{0} {1:.1f} s'.format(stage, timing[stage]) for stage in STAGES))
+    event_number = np.zeros((1, hrfa.shape[1]))
+    for voxel_id in range(hrfa.shape[1]):
         event_number[:, voxel_id] = np.amax(event_bold[voxel_id].shape)
-    print('Done')
     print('Saving Output ...')
-    # setting the output-path
-    if mode == 'bids' or mode == 'bids w/ atlas':
-        layout_output = BIDSLayout(output_dir)
-        entities = parse_file_entities(input_file)
-        sub_save_dir = layout_output.build_path(entities).rsplit('/',1)[0]            
-    else:
-        sub_save_dir = output_dir
-    if not os.path.isdir(sub_save_dir):
-        os.makedirs(sub_save_dir, exist_ok=True)
     dic = {'para': para, 'hrfa': hrfa, 'event_bold': event_bold, 'PARA': PARA}
-    ext = '_hrf.mat'
+    ext = '_hrf'
     if mode == "time-series":
         dic["event_number"] = event_number
         dic["data_deconv"]  = data_deconv
-        ext = '_hrf_deconv.mat'
+        ext = '_hrf_deconv'
     name = name.rsplit('_bold', 1)[0]   
-    sio.savemat(os.path.join(sub_save_dir, name + ext), dic)
+    utils.result_store.save_results(os.path.join(sub_save_dir, name + ext), dic, output_format)
     HRF_para_str = ['height', 'T2P', 'FWHM']
     if mode != "time-series":
-        mask_data = np.zeros(mask_shape).flatten(order='F')
         for i in range(3):
             fname = os.path.join(sub_save_dir,
                                  name + '_' + HRF_para_str[i])
-            mask_data[voxel_ind] = PARA[i, :]
-            mask_data = mask_data.reshape(mask_shape, order='F')
-            spm_dep.spm.spm_write_vol(v1, mask_data, fname, file_type)
-            mask_data = mask_data.flatten(order='F')
+            spm_dep.spm.spm_write_vol(v1, PARA[i, :].astype(dtype), fname, file_type, codec)
         fname = os.path.join(sub_save_dir, name + '_eventnumber')
-        mask_data[voxel_ind] = event_number
-        mask_data = mask_data.reshape(mask_shape, order='F')
-        spm_dep.spm.spm_write_vol(v1, mask_data, fname, file_type)
-        mask_data = np.zeros(data.shape)
-        dat3 = np.zeros(data.shape[:-1]).flatten(order='F')
-        for i in range(nobs):
-            fname = os.path.join(sub_save_dir, name + '_deconv')
-            dat3[voxel_ind] = data_deconv[i, :]
-            dat3 = dat3.reshape(data.shape[:-1], order='F')
-            if file_type == ".nii" or file_type == ".nii.gz" :
-                mask_data[:, :, :, i] = dat3
-            else:
-                mask_data[:, i] = dat3
-            dat3 = dat3.flatten(order='F')
-        spm_dep.spm.spm_write_vol(v1, mask_data, fname, file_type)
+        spm_dep.spm.spm_write_vol(v1, event_number[0].astype(dtype), fname, file_type, codec)
+        # the deconvolved image is written frame by frame
+        fname = os.path.join(sub_save_dir, name + '_deconv')
+        if stream:
+            deconv_vol.flush()
+            frames = (deconv_vol[..., i] for i in range(nobs))
+        else:
+            deconv_max = np.nanmax(np.abs(data_deconv)) if data_deconv.size else 0.
+            frames = codec.frames(data_deconv, dtype)
+        if not (stream and deconv_direct):
+            spm_dep.spm.spm_write_vol_frames(v1, frames, mask_shape + (nobs,), fname, file_type,
+                                             deconv_dtype, spm_dep.spm.spm_scale_factor(deconv_max, deconv_dtype))
     pos = 0
     while pos < hrfa_TR.shape[1]:
         if np.any(hrfa_TR[:,pos]):
             break 
         pos += 1
+    if stream:
+        if pos < hrfa_TR.shape[1]:
+            deconv_plot = np.array(deconv_vox[voxel_ind[pos], :])
+        del deconv_vox, deconv_vol
+        if not deconv_direct:
+            os.remove(deconv_file)
     event_plot = lil_matrix((1, nobs))
     if event_bold.size:
         event_plot[:, event_bold[pos]] = 1
     else:
         print("No Events Detected!")
         return 0
+    if stream:
+        bold_plot   = plot_sig
+    else:
+        bold_plot   = bold_sig[:, pos]
+        deconv_plot = data_deconv[:, pos]
     event_plot = np.ravel(event_plot.toarray())
     plt.figure()
     plt.plot(para['TR'] * np.arange(1, np.amax(hrfa_TR[:, pos].shape) + 1),
@@ -194,10 +221,10 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
     plt.savefig(os.path.join(sub_save_dir, name + '_hrf_plot.png'))
     plt.figure()
     plt.plot(para['TR'] * np.arange(1, nobs + 1),
-             np.nan_to_num(stats.zscore(bold_sig[:, pos], ddof=1)),
+             np.nan_to_num(stats.zscore(bold_plot, ddof=1)),
              linewidth=1)
     plt.plot(para['TR'] * np.arange(1, nobs + 1),
-             np.nan_to_num(stats.zscore(data_deconv[:, pos], ddof=1)),
+             np.nan_to_num(stats.zscore(deconv_plot, ddof=1)),
              color='r', linewidth=1)
     markerline, stemlines, baseline = \
         plt.stem(para['TR'] * np.arange(1, nobs + 1), event_plot)
@@ -209,3 +236,130 @@ def demo_rsHRF(input_file, mask_file, output_dir, para, p_jobs, file_type=".nii"
     plt.savefig(os.path.join(sub_save_dir, name + '_deconvolution_plot.png'))   
     print('Done')
     return 0
+
+def hrf_stages(bold_sig, para, temporal_mask, p_jobs, bf=None, wiener=False,
+               backend='processes', progress=None, timing=None):
+    """
+    Runs the HRF estimation, parameter and deconvolution stages on the
+    z-scored BOLD signal (nobs x nvar), each in parallel blocks of voxels
+    @progress - called as progress(stage, done, nvar)
+    @timing - dictionary to which the seconds spent in each stage are added
+    Returns the filtered signal, the HRFs (at the estimation time bins
+    and at TR), the events, the HRF parameters and the deconvolved signal
+    """
+    if timing is None:
+        timing = dict.fromkeys(STAGES, 0.)
+    def stage_progress(stage):
+        if progress is None:
+            return None
+        return functools.partial(progress, stage)
+    t = time.time()
+    bold_sig, bold_sig_deconv, hrfa, event_bold = \
+        retrieve_hrf(bold_sig, para, temporal_mask, p_jobs, bf, backend, stage_progress(STAGES[0]))
+    timing[STAGES[0]] += time.time() - t
+    t = time.time()
+    PARA = hrf_parameters(hrfa, para, p_jobs, backend, stage_progress(STAGES[1]))
+    timing[STAGES[1]] += time.time() - t
+    t = time.time()
+    hrfa_TR = hrf_at_TR(hrfa, para)
+    data_deconv = deconvolve_bold(bold_sig_deconv, hrfa_TR, para, p_jobs, wiener,
+                                  backend, stage_progress(STAGES[2]))
+    timing[STAGES[2]] += time.time() - t
+    return bold_sig, hrfa, hrfa_TR, event_bold, PARA, data_deconv
+
+def retrieve_hrf(bold_sig, para, temporal_mask, p_jobs, bf=None, backend='processes', progress=None):
+    """
+    Filters the z-scored BOLD signal (nobs x nvar) and retrieves the HRF
+    of every voxel
+    @bf - basis functions (None for FIR / sFIR)
+    """
+    bold_sig = np.nan_to_num(bold_sig)
+    if processing.rest_filter.wgr_is_allpass(bold_sig.shape[0], para['TR'], para['passband_deconvolve']):
+        # default [0, inf] band: the deconvolution input is the z-scored
+        # signal itself (rest_IdealFilter would only add back its zero
+        # means). The baseline filtered in place and deconvolved the
+        # passband-filtered signal instead.
+        bold_sig_deconv = bold_sig
+        bold_sig = processing. \
+                   rest_filter. \
+                   rest_IdealFilter(bold_sig, para['TR'], para['passband'])
+    else:
+        bold_sig_deconv, bold_sig = processing. \
+                                    rest_filter. \
+                                    rest_IdealFilter_bands(bold_sig, para['TR'],
+                                                           [para['passband_deconvolve'], para['passband']])
+    #Estimate HRF for the fourier / hanning / gamma / cannon basis functions
+    if bf is not None:
+        beta_hrf, event_bold = utils.hrf_estimation.compute_hrf(bold_sig, para, temporal_mask, p_jobs, bf=bf, backend=backend, progress=progress)
+        hrfa = np.dot(bf, beta_hrf[np.arange(0, bf.shape[1]), :])
+    #Estimate HRF for FIR and sFIR
+    else:
+        beta_hrf, event_bold = utils.hrf_estimation.compute_hrf(bold_sig, para, temporal_mask, p_jobs, backend=backend, progress=progress)
+        hrfa = beta_hrf[:-1,:]
+    return bold_sig, bold_sig_deconv, hrfa, event_bold
+
+def hrf_parameters(hrfa, para, p_jobs, backend='processes', progress=None):
+    """
+    Height, time to peak and FWHM of every HRF (3 x nvar)
+    """
+    (PARA,), _ = utils.parallel.map_voxel_chunks(
+        _parameters_block, [hrfa], [3], p_jobs, context=para['TR'] / para['T'],
+        backend=backend, progress=progress)
+    return PARA
+
+def _parameters_block(dt, hrfa):
+    return [parameters.wgr_get_parameters_batch(hrfa, dt)], None
+
+def hrf_at_TR(hrfa, para):
+    """
+    Resamples the HRFs from the time bins of the estimation to TR
+    """
+    if para['T'] > 1:
+        return signal.resample_poly(hrfa, 1, para['T'])
+    return hrfa
+
+def deconvolve_bold(bold_sig_deconv, hrfa_TR, para, p_jobs, wiener=False,
+                    backend='processes', progress=None):
+    """
+    Deconvolves every voxel of the BOLD signal with its HRF (sampled at TR)
+    """
+    (data_deconv,), _ = utils.parallel.map_voxel_chunks(
+        _deconvolve_block, [bold_sig_deconv, hrfa_TR], [bold_sig_deconv.shape[0]], p_jobs,
+        context=(para, wiener), backend=backend, dtype=bold_sig_deconv.dtype,
+        progress=progress)
+    return data_deconv
+
+def _deconvolve_block(context, bold_sig_deconv, hrfa_TR):
+    para, wiener = context
+    if not wiener:
+        return [processing.deconv.fft_deconv(bold_sig_deconv, hrfa_TR)], None
+    # Use new API with MATLAB v2.5 features (auto-recommendations based on TR and Mode)
+    # Default to 'rest' mode for resting-state fMRI (can be overridden in para dict)
+    deconv_mode = para.get('deconv_mode', 'rest')
+    data_deconv = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv_batch(
+        bold_sig_deconv,
+        hrfa_TR,
+        TR=para['TR'],
+        MaxIter=para.get('deconv_MaxIter', 50),
+        Tol=para.get('deconv_Tol', 1e-4),
+        Mode=deconv_mode
+    )
+    return [data_deconv], None
+
+def slab_bounds(shape, slab_size):
+    """
+    Ranges of slices along the last spatial axis, of at most slab_size
+    voxels each (at least one slice)
+    """
+    plane = int(np.prod(shape[:-1]))
+    step = max(int(slab_size) // plane, 1)
+    return [(z, min(z + step, shape[-1])) for z in range(0, shape[-1], step)]
+
+def read_slab(v1, z0, z1):
+    """
+    Reads slices z0:z1 of a 4D image through its array proxy, as a
+    (nobs x nvoxels) matrix in the (Fortran) order of the flattened volume
+    """
+    index = (slice(None),) * (len(v1.shape) - 2) + (slice(z0, z1), slice(None))
+    slab = np.asarray(v1.dataobj[index])
+    return slab.reshape((-1, v1.shape[-1]), order='F').T
@@ -2,6 +2,7 @@ import pywt
 import numpy as np
 from scipy.signal.windows import gaussian
 from scipy.signal import convolve
+from scipy.fft import next_fast_len
 from rsHRF.processing import knee
 import warnings
 
@@ -111,40 +112,8 @@ def rsHRF_iterative_wiener_deconv(y, h,
     elif nh > N:
         h = h[:N]
 
-    # Calculate sampling rate
-    if TR is not None:
-        fs = 1.0 / TR
-        nyquist = fs / 2.0
-    else:
-        fs = 1.0
-        nyquist = 0.5
-
-    # ============ AUTO-RECOMMENDATIONS ============
-    # Based on MATLAB v2.5 lines 44-58
-
-    if Smooth is None or LowPass is None:
-        if Mode.lower() == 'rest':
-            if TR is not None:
-                smooth_rec = max(int(np.round(4.0 / TR)), 3)
-                lowpass_rec = min(0.2, 0.8 * nyquist)
-            else:
-                smooth_rec = 3
-                lowpass_rec = 0.2
-        elif Mode.lower() == 'task':
-            if TR is not None:
-                smooth_rec = max(int(np.round(2.0 / TR)), 2)
-                lowpass_rec = min(0.35, 0.9 * nyquist)
-            else:
-                smooth_rec = 2
-                lowpass_rec = 0.35
-        else:
-            raise ValueError(f"Unknown Mode: {Mode}. Use 'rest' or 'task'.")
-
-    # Apply auto-recommendations if parameters not provided
-    if Smooth is None:
-        Smooth = smooth_rec
-    if LowPass is None:
-        LowPass = lowpass_rec
+    # Sampling rate and auto-recommended smoothing / low-pass cutoff
+    Smooth, LowPass, fs, nyquist = _smooth_lowpass(TR, Mode, Smooth, LowPass)
 
     # ============ FFT PREPROCESSING ============
 
@@ -220,3 +189,179 @@ def rsHRF_iterative_wiener_deconv(y, h,
         Pxx = Pxx_new
 
     return xhat
+
+
+def _smooth_lowpass(TR, Mode, Smooth, LowPass):
+    """
+    Sampling rate, Nyquist frequency and the smoothing window / low-pass
+    cutoff, auto-recommended from Mode and TR when not provided
+    (MATLAB v2.5 lines 44-58)
+    """
+    if TR is not None:
+        fs = 1.0 / TR
+        nyquist = fs / 2.0
+    else:
+        fs = 1.0
+        nyquist = 0.5
+
+    if Smooth is None or LowPass is None:
+        if Mode.lower() == 'rest':
+            if TR is not None:
+                smooth_rec = max(int(np.round(4.0 / TR)), 3)
+                lowpass_rec = min(0.2, 0.8 * nyquist)
+            else:
+                smooth_rec = 3
+                lowpass_rec = 0.2
+        elif Mode.lower() == 'task':
+            if TR is not None:
+                smooth_rec = max(int(np.round(2.0 / TR)), 2)
+                lowpass_rec = min(0.35, 0.9 * nyquist)
+            else:
+                smooth_rec = 2
+                lowpass_rec = 0.35
+        else:
+            raise ValueError(f"Unknown Mode: {Mode}. Use 'rest' or 'task'.")
+
+    # Apply auto-recommendations if parameters not provided
+    if Smooth is None:
+        Smooth = smooth_rec
+    if LowPass is None:
+        LowPass = lowpass_rec
+    return Smooth, LowPass, fs, nyquist
+
+
+def _wavelet_noise(r, N):
+    """
+    Noise power sigma^2 * N of every row of r, with sigma the MAD of
+    the db2 detail coefficients of |r|
+    """
+    detail_coeffs = pywt.wavedec(np.abs(r), 'db2', level=1, axis=-1)[-1]
+    sigma = np.median(np.abs(detail_coeffs), axis=-1) / 0.6745
+    return sigma**2 * N
+
+
+def _convolve_same(x, g):
+    """
+    convolve(x, g, mode='same') along the rows of x, for a short kernel g
+    """
+    N = x.shape[-1]
+    s = (g.size - 1) // 2
+    out = np.zeros(x.shape)
+    for m in range(g.size):
+        d = s - m
+        if d >= 0 and d < N:
+            out[:, :N - d] += g[m] * x[:, d:]
+        elif d < 0 and -d < N:
+            out[:, -d:] += g[m] * x[:, :N + d]
+    return out
+
+
+def rsHRF_iterative_wiener_deconv_batch(y, h,
+                                         TR=None,
+                                         MaxIter=50,
+                                         Tol=1e-4,
+                                         Mode='rest',
+                                         Smooth=None,
+                                         LowPass=None):
+    """
+    Iterative Wiener-like deconvolution of many signals at once.
+
+    Same algorithm as rsHRF_iterative_wiener_deconv, applied to all the
+    columns together: each voxel stops being updated once it meets Tol,
+    and the Gaussian kernel and the low-pass mask are built only once.
+
+    Parameters
+    ----------
+    y : ndarray
+        Observed signals (N x nvar)
+    h : ndarray
+        HRFs (Nh x nvar), or a single HRF (Nh,) shared by all signals
+    TR, MaxIter, Tol, Mode, Smooth, LowPass :
+        See rsHRF_iterative_wiener_deconv
+
+    Returns
+    -------
+    xhat : ndarray
+        Deconvolved signals (N x nvar)
+    """
+    # voxels along the rows, so that every transform is over contiguous data
+    y = np.array(np.atleast_2d(np.asarray(y, dtype=float).T))
+    h = np.atleast_2d(np.asarray(h, dtype=float).T)
+    nvar, N = y.shape
+    h = np.broadcast_to(h, (nvar, h.shape[1]))
+
+    # ============ PREPROCESSING ============
+
+    y -= np.nanmean(y, axis=1)[:, np.newaxis]
+    nh = h.shape[1]
+    if nh < N:
+        h = np.concatenate((h, np.zeros((nvar, N - nh))), axis=1)
+    else:
+        h = h[:, :N]
+
+    Smooth, LowPass, fs, nyquist = _smooth_lowpass(TR, Mode, Smooth, LowPass)
+
+    # ============ FFT PREPROCESSING ============
+    # real signals: half spectra (rfft) are enough for the elementwise updates
+
+    H = np.fft.rfft(h)
+    Y = np.fft.rfft(y)
+    H2 = np.abs(H)**2
+    # 'same' convolution with h, as the centre of the full linear convolution
+    nfull = next_fast_len(2 * N - 1)
+    H_full = np.fft.rfft(h, n=nfull)
+    start = (N - 1) // 2
+
+    if Smooth > 1:
+        g = gaussian(int(Smooth), std=Smooth/4.0)
+        g = g / np.sum(g)
+    if LowPass < nyquist:
+        # the full-spectrum filter keeps bins 0..fc only and takes the real
+        # part, i.e. the kept non-DC components are halved
+        f = np.arange(Y.shape[1]) / N * fs
+        lowpass_mask = np.where(f > LowPass, 0., 0.5)
+        lowpass_mask[0] = 1.
+
+    xhat = y.copy()
+    Pxx = np.abs(Y)**2
+    Nf = _wavelet_noise(y, N)
+
+    # ============ ITERATIVE PROCESS ============
+
+    active = np.arange(nvar)
+    for iteration in range(MaxIter):
+        if active.size == 0:
+            break
+        Ya, Ha, H2a, Pxxa = Y[active], H[active], H2[active], Pxx[active]
+        Nfa = Nf[active, np.newaxis]
+
+        M = (np.conj(Ha) * Pxxa * Ya) / (H2a * Pxxa + Nfa)
+        PxxY = (Pxxa * Nfa) / (H2a * Pxxa + Nfa)
+        Pxx_new = PxxY + np.abs(M)**2
+
+        WienerFilterEst = (np.conj(Ha) * Pxx_new) / (H2a * Pxx_new + Nfa)
+        xhat_new = np.fft.irfft(WienerFilterEst * Ya, n=N)
+
+        if Smooth > 1:
+            xhat_new = _convolve_same(xhat_new, g)
+
+        if LowPass < nyquist:
+            xhat_new = np.fft.irfft(np.fft.rfft(xhat_new) * lowpass_mask, n=N)
+
+        # ============ DYNAMIC NOISE UPDATE ============
+
+        conv = np.fft.irfft(np.fft.rfft(xhat_new, n=nfull) * H_full[active],
+                            n=nfull)[:, start:start + N]
+        Nf[active] = _wavelet_noise(y[active] - conv, N)
+
+        # ============ CONVERGENCE CHECK ============
+
+        norm_diff = np.linalg.norm(xhat_new - xhat[active], axis=1)
+        norm_xhat = np.linalg.norm(xhat[active], axis=1)
+        converged = (norm_xhat > 0) & (norm_diff < Tol * norm_xhat)
+
+        xhat[active] = xhat_new
+        Pxx[active] = Pxx_new
+        active = active[~converged]
+
+    return xhat.T
@@ -42,3 +42,46 @@ def wgr_get_parameters(hdrf, dt):
     else:
         print('.')
     return param.ravel()
+
+def wgr_get_parameters_batch(hdrf, dt):
+    """
+    Find Model Parameters of every column of hdrf (nbins x nvar), as
+    wgr_get_parameters; returns PARA (3 x nvar)
+    """
+    hdrf = np.asarray(hdrf)
+    L, nvar = hdrf.shape
+    PARA = np.zeros((3, nvar))
+    nonzero = np.any(hdrf, axis=0)
+    if not np.all(nonzero):
+        print('\n'.join('.' * int(np.sum(~nonzero))))
+    hdrf = hdrf[:, nonzero]
+    if hdrf.shape[1] == 0:
+        return PARA
+    cols = np.arange(hdrf.shape[1])
+    n = int(np.fix(L * 0.8))
+
+    p = np.argmax(np.absolute(hdrf[:n]), axis=0)
+    h = hdrf[p, cols]
+
+    v = np.where(h > 0, hdrf >= (h / 2), hdrf <= (h / 2)).astype(int)
+    # ones up to (and including) the first fall of v
+    b = np.argmin(np.diff(v, axis=0), axis=0)
+    w = np.sum(v * (np.arange(L)[:, np.newaxis] <= b), axis=0)
+
+    # walk back from the peak over flat gradients: stop at the last
+    # non-flat gradient (or the first sample) at or before p - 1
+    g = hdrf[1:] - hdrf[0:-1]
+    stop = np.abs(g) >= 0.001
+    stop |= np.isnan(g)
+    stop[0] = True
+    last_stop = np.maximum.accumulate(np.where(stop, np.arange(L - 1)[:, np.newaxis], -1), axis=0)
+    cnt = p - 1
+    stop_cnt = np.where(cnt > 0, last_stop[np.maximum(cnt, 0), cols], cnt)
+    moved = stop_cnt < cnt
+    h = np.where(moved, hdrf[np.maximum(stop_cnt, 0), cols], h)
+    p = np.where(moved, stop_cnt + 1, p)
+
+    PARA[0, nonzero] = h
+    PARA[1, nonzero] = (p + 1) * dt
+    PARA[2, nonzero] = w * dt
+    return PARA
@@ -1,2 +1,3 @@
 from . import knee
 from . import rest_filter
+from . import deconv
@@ -0,0 +1,27 @@
+import numpy as np
+import warnings
+
+warnings.filterwarnings("ignore")
+
+def fft_deconv(bold_sig, hrfa_TR, chunk_size=5000):
+    """
+    Regularised (Wiener) deconvolution of every column of bold_sig with
+    the matching column of hrfa_TR, using real FFTs along the time axis
+    @bold_sig - BOLD signals (nobs x nvar)
+    @hrfa_TR  - HRFs sampled at TR (nh x nvar), zero-padded to nobs
+    @chunk_size - number of voxels transformed at once (None: all)
+    """
+    nobs, nvar = bold_sig.shape
+    if chunk_size is None:
+        chunk_size = max(nvar, 1)
+    data_deconv = np.zeros(bold_sig.shape, dtype=bold_sig.dtype)
+    for i in range(0, nvar, chunk_size):
+        ind = slice(i, min(i + chunk_size, nvar))
+        hrf = hrfa_TR[:, ind]
+        H = np.fft.rfft(hrf, n=nobs, axis=0)
+        M = np.fft.rfft(bold_sig[:, ind], axis=0)
+        # mean(|H|^2) over the full spectrum equals sum(h^2) (Parseval)
+        noise = .1 * np.sum(hrf ** 2, axis=0)
+        data_deconv[:, ind] = np.fft.irfft(H.conj() * M / (H.real ** 2 + H.imag ** 2 + noise),
+                                           n=nobs, axis=0)
+    return data_deconv
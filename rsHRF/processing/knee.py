@@ -88,3 +88,64 @@ def knee_pt_helper(y, x=None):
             res_x = x[loc]
             idx_of_result = idx[loc]
     return res_x, idx_of_result
+
+def knee_pt_batch(y):
+    """
+    knee_pt of every row of y (nvar x nlag), with x = 1..nlag
+    Returns the arrays of res_x and of the knee indices
+    """
+    y = np.asarray(y)
+    nvar, L = y.shape
+    _idm = np.argmin(y, axis=1)
+    if L < 3:
+        return np.min(y, axis=1), _idm
+    res_x, _id = knee_pt_helper_batch(y)
+    rows = np.arange(nvar)
+    ratio = np.abs(y[rows, _id] - y[rows, _idm]) / np.abs(np.max(y, axis=1) - np.min(y, axis=1))
+    return res_x, np.where(ratio > 0.5, _idm, _id)
+
+def knee_pt_helper_batch(y):
+    """
+    knee_pt_helper of every row of y (nvar x nlag, nlag >= 3), with
+    x = 1..nlag: the absolute-deviation error curves of all rows and
+    breakpoints are computed at once
+    """
+    nvar, L = y.shape
+    x = np.arange(1, L + 1, dtype=int)
+    mfwd, bfwd = _cum_line_fit(x, y)
+    mbck, bbck = _cum_line_fit(x[::-1], y[:, ::-1])
+    mbck, bbck = mbck[:, ::-1], bbck[:, ::-1]
+
+    # residuals of the fits at every breakpoint (nvar x nbreak x nlag)
+    breakpt = np.arange(1, L - 1)
+    i = np.arange(L)
+    delsfwd = (mfwd[:, breakpt, np.newaxis] * x + bfwd[:, breakpt, np.newaxis]) - y[:, np.newaxis, :]
+    delsbck = (mbck[:, breakpt, np.newaxis] * x + bbck[:, breakpt, np.newaxis]) - y[:, np.newaxis, :]
+    error_curve = np.full(y.shape, np.nan)
+    error_curve[:, breakpt] = \
+        np.sum(np.where(i <= breakpt[:, np.newaxis], np.abs(delsfwd), 0), axis=2) + \
+        np.sum(np.where(i >= breakpt[:, np.newaxis], np.abs(delsbck), 0), axis=2)
+
+    # rows without any valid breakpoint fall back to the first point
+    all_nan = np.all(np.isnan(error_curve), axis=1)
+    error_curve[all_nan] = 0
+    loc = np.nanargmin(error_curve, axis=1)
+    return x[loc], loc
+
+def _cum_line_fit(x, y):
+    """
+    Slopes and intercepts of the least-squares lines through the first
+    1..nlag points of every row of y
+    """
+    sigma_xy = np.cumsum(np.multiply(x, y), axis=1)
+    sigma_x = np.cumsum(x)
+    sigma_y = np.cumsum(y, axis=1)
+    sigma_xx = np.cumsum(np.multiply(x, x))
+    n = np.arange(1, x.size + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = np.multiply(n, sigma_xx) - np.multiply(sigma_x, sigma_x)
+        m = (np.multiply(n, sigma_xy) -
+             np.multiply(sigma_x, sigma_y)) / det
+        b = -1 * ((np.multiply(sigma_x, sigma_xy) -
+                   np.multiply(sigma_xx, sigma_y)) / det)
+    return m, b
@@ -1,22 +1,63 @@
+import functools
 import numpy as np
-import numpy.matlib
+from scipy import fftpack
 import warnings
 
 warnings.filterwarnings("ignore")
 
 def rest_IdealFilter(x, TR, Bands, m=5000):
-    nvar = x.shape[1]
-    nbin = int(np.ceil(nvar/m))
-    for i in range(1, nbin + 1):
-        if i != nbin:
-            ind_X = [j for j in range((i-1)*m, i*m)]
-        else:
-            ind_X = [j for j in range((i-1)*m, nvar)]
-        x1 = x[:, ind_X]
-        x1 = conn_filter(TR,Bands,x1) + np.matlib.repmat(np.mean(x1), x1.shape[0], 1)
-        x[:,ind_X] = x1
-    return x
-        
+    """
+    Ideal band-pass filter of the columns of x (nobs x nvar), on the
+    mirrored signal (conn_filter), with the column means added back.
+    x is left unchanged; returns the filtered copy
+    """
+    return rest_IdealFilter_bands(x, TR, [Bands], m)[0]
+
+def rest_IdealFilter_bands(x, TR, bands, m=5000):
+    """
+    rest_IdealFilter of x for each of the passbands, from one forward
+    transform per block of m voxels
+    The spectrum of the mirrored signal [x; flipud(x)] is real and even:
+    its FFT is (up to a phase) the DCT-II of x, so the filters run on the
+    DCT of x (half the length, no mirrored copy) with the same masks.
+    Returns the list of filtered arrays (nobs x nvar each)
+    """
+    x = np.asarray(x)
+    N, nvar = x.shape
+    dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    masks = [wgr_band_mask(N, float(TR), float(band[0]), float(band[1])) for band in bands]
+    out = [np.empty((N, nvar), dtype=dtype) for band in bands]
+    work = np.empty((N, min(m, nvar)), dtype=dtype)
+    for start in range(0, nvar, m):
+        stop = min(start + m, nvar)
+        x1 = x[:, start:stop]
+        coef = fftpack.dct(x1, type=2, axis=0, norm='ortho')
+        mean = np.mean(x1, axis=0)
+        for y, mask in zip(out, masks):
+            spec = work[:, :stop - start]
+            np.multiply(coef, mask[:, np.newaxis], out=spec)
+            y[:, start:stop] = fftpack.idct(spec, type=2, axis=0, norm='ortho', overwrite_x=True)
+            y[:, start:stop] += mean
+    return out
+
+@functools.lru_cache(maxsize=None)
+def wgr_band_mask(N, TR, low, high):
+    """
+    Frequency mask of conn_filter for N samples (on the 2N mirrored
+    signal), over the N DCT coefficients; cached per (N, TR, band)
+    """
+    f = np.arange(N)
+    mask = ((f >= low * (TR * 2 * N)) & (f < high * (TR * 2 * N))).astype(float)
+    mask.flags.writeable = False
+    return mask
+
+def wgr_is_allpass(N, TR, band):
+    """
+    Whether the band keeps every frequency of N samples (e.g. [0, inf]),
+    i.e. rest_IdealFilter only adds the column means back
+    """
+    return bool(np.all(wgr_band_mask(N, float(TR), float(band[0]), float(band[1]))))
+
 def conn_filter(rt, filter, x):
     Nx = x.shape[0]
     fy = np.fft.fft(np.concatenate((x, np.flipud(x)), axis=0), axis=0)
@@ -31,4 +72,4 @@ def conn_filter(rt, filter, x):
     fy[idx,:] = 0.
     y = np.real(np.fft.ifft(fy, axis=0))
     y = y[0:Nx,:]
-    return y
\ No newline at end of file
+    return y
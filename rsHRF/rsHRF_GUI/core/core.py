@@ -288,18 +288,10 @@ class Core():
         # inputs for obtaining the parameters
         hrfa = hrf.get_ts()
         para = hrf.get_parameters().get_parameters()
-        nvar = hrfa.shape[1]
-        PARA = np.zeros((3, nvar))
-        average = [0 for i in range(3)]
-        # obtaining the parameters for each voxel
-        for voxel_id in range(nvar):
-            hrf1 = hrfa[:, voxel_id]
-            PARA[:, voxel_id] = parameters.wgr_get_parameters(
-                hrf1, para['TR'] / para['T'])
-            for i in range(3):
-                average[i] += PARA[i, voxel_id]
-        for i in range(3):
-            average[i] /= nvar
+        # obtaining the parameters of all voxels at once
+        PARA = parameters.wgr_get_parameters_batch(
+            hrfa, para['TR'] / para['T'])
+        average = [np.mean(PARA[i]) for i in range(3)]
         # setting the parameters
         hrf.set_para(PARA)
         # returning the status
@@ -327,21 +319,14 @@ class Core():
                 ), self.parameters.get_passband_deconvolve())
             event_bold = hrf.get_event_bold()
             nvar = hrfa.shape[1]
-            nobs = bold_sig.shape[0]
-            data_deconv = np.zeros(bold_sig.shape)
             event_number = np.zeros((1, bold_sig.shape[1]))
             if para['T'] > 1:
                 hrfa_TR = signal.resample_poly(hrfa, 1, para['T'])
             else:
                 hrfa_TR = hrfa
-            # obtaining the deconvolved BOLD for each voxel
+            # obtaining the deconvolved BOLD for all voxels at once
+            data_deconv = processing.deconv.fft_deconv(bold_sig, hrfa_TR)
             for voxel_id in range(nvar):
-                hrf_ = hrfa_TR[:, voxel_id]
-                H = np.fft.fft(np.append(hrf_, np.zeros(
-                    (nobs - max(hrf_.shape), 1))), axis=0)
-                M = np.fft.fft(bold_sig[:, voxel_id])
-                data_deconv[:, voxel_id] = np.fft.ifft(
-                    H.conj() * M / (H * H.conj() + .1*np.mean((H * H.conj()))))
                 event_number[:, voxel_id] = np.amax(event_bold[voxel_id].shape)
             # instantiating the time-series object
             dd = Bold_Deconv(label="Deconvolved-BOLD", ts=data_deconv,
@@ -1,11 +1,44 @@
+import functools
 import numpy as np
 from scipy        import linalg
+from scipy.linalg import lapack
 from ..processing import knee
 
 import warnings
 warnings.filterwarnings("ignore")
 
 def wgr_regress(y, X):
+    """
+    Least-squares Beta of y = X * Beta
+    Thin, well-conditioned designs are solved from the normal equations
+    (Cholesky); the others go through the pivoted QR of _wgr_regress_qr.
+    """
+    n, ncolX = X.shape
+    if n >= ncolX:
+        b = _wgr_regress_chol(y, X)
+        if b is not None:
+            return b
+    return _wgr_regress_qr(y, X)
+
+def _wgr_regress_chol(y, X, cond_max=1e8):
+    """
+    Normal equations through the Cholesky factor of X'X, with the LAPACK
+    condition estimate as a guard; returns None when X'X is not safely
+    positive definite (rank-deficient or ill-conditioned designs)
+    """
+    G = np.dot(X.T, X)
+    c, info = lapack.dpotrf(G)
+    if info != 0:
+        return None
+    rcond, info = lapack.dpocon(c, np.max(np.sum(np.abs(G), axis=0)))
+    if info != 0 or not rcond * cond_max > 1:
+        return None
+    b, info = lapack.dpotrs(c, np.dot(X.T, y))
+    if info != 0:
+        return None
+    return b
+
+def _wgr_regress_qr(y, X):
     n, ncolX = X.shape
     Q,R,perm = linalg.qr(X, mode='economic', pivoting=True)
     if R.ndim == 0:
@@ -31,6 +64,32 @@ def wgr_regress(y, X):
         b[perm] = linalg.lstsq(R,np.matmul(Q.T,y))
     return b
 
+def wgr_regress_batch(Y, X):
+    """
+    Stacked least-squares for many small designs at once
+    @Y - dependent variables (... x n)
+    @X - regressors (... x n x k)
+    Full-rank problems are solved together through a stacked SVD;
+    rank-deficient ones fall back to the pivoted-QR wgr_regress.
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    n, ncolX = X.shape[-2:]
+    batch = X.shape[:-2]
+    X = X.reshape((-1, n, ncolX))
+    Y = Y.reshape((-1, n))
+    b = np.zeros((X.shape[0], ncolX))
+    if X.shape[0] == 0:
+        return b.reshape(batch + (ncolX,))
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    full = s[:, -1] > max(n, ncolX) * np.spacing(s[:, 0])
+    if np.any(full):
+        Uty = np.einsum('bnk,bn->bk', U[full], Y[full])
+        b[full] = np.einsum('bkj,bk->bj', Vt[full], Uty / s[full])
+    for i in np.where(~full)[0]:
+        b[i] = wgr_regress(Y[i], X[i])
+    return b.reshape(batch + (ncolX,))
+
 def wgr_glsco(X, Y, sMRI = [], AR_lag=0, max_iter=20):
     """
     Linear regression when disturbance terms follow AR(p)
@@ -90,28 +149,184 @@ def wgr_glsco(X, Y, sMRI = [], AR_lag=0, max_iter=20):
             break
     res_sum = np.cov(resid)
     return res_sum, Beta
-    
+
+def wgr_glsco_batch(X, Y, AR_lag=0, max_iter=20, sMRI=None):
+    """
+    wgr_glsco for a stack of problems
+    @X - regressors (... x n x k)
+    @Y - dependent variables (... x n), broadcast against X; a signal
+         shared by several designs (e.g. the lags of one voxel) is
+         only multiplied once, and so is a design shared by many voxels
+    @sMRI - smoothness prior of sFIR (k x k), as in wgr_glsco
+    The Cochrane-Orcutt iterations run on the lag-shifted Gram matrices
+    of [X, Y], all problems together until each one meets its own
+    tolerance. Ill-conditioned problems fall back to wgr_glsco.
+    Returns res_sum (...) and Beta (... x k)
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    nobs, nvar = X.shape[-2:]
+    p = AR_lag
+    batch = np.broadcast(X[..., 0, 0], Y[..., 0]).shape
+    M = _lagged_gram(X, Y, p, p, nobs)
+    G0 = M[..., 0, :, 0, :] + _lagged_gram(X, Y, 0, 0, p)[..., 0, :, 0, :]
+    S1 = _col_sums(X[..., p:, :], Y[..., p:], batch)
+    S0 = S1 + _col_sums(X[..., :p, :], Y[..., :p], batch)
+    M = np.broadcast_to(M, batch + M.shape[-4:]).reshape((-1,) + M.shape[-4:])
+    G0 = np.broadcast_to(G0, batch + G0.shape[-2:]).reshape((-1,) + G0.shape[-2:])
+    Ma = Mb = None
+    if p > 0:
+        Ma = M - np.broadcast_to(_lagged_gram(X, Y, p, nobs - p, nobs),
+                                 batch + M.shape[-4:]).reshape(M.shape)
+        Mb = M - np.broadcast_to(_lagged_gram(X, Y, p, p, 2 * p),
+                                 batch + M.shape[-4:]).reshape(M.shape)
+    res_sum, Beta, ok = _glsco_gram(M, Ma, Mb, G0, S0, S1, nobs, p, max_iter, sMRI)
+    for i in np.where(~ok)[0]:
+        j = np.unravel_index(i, batch)
+        Xi = np.broadcast_to(X, batch + (nobs, nvar))[j]
+        Yi = np.broadcast_to(Y, batch + (nobs,))[j]
+        res_sum[i], Beta[i] = wgr_glsco(Xi, Yi, AR_lag=AR_lag, max_iter=max_iter,
+                                        sMRI=[] if sMRI is None else sMRI)
+    return res_sum.reshape(batch), Beta.reshape(batch + (nvar,))
+
+def _glsco_gram(M, Ma, Mb, G0, S0, S1, nobs, p, max_iter=20, sMRI=None):
+    """
+    Cochrane-Orcutt iterations of wgr_glsco on the Gram matrices of a
+    stack of problems Z = [X, Y] (flattened over the problems):
+    @M, Ma, Mb - lag-shifted Grams (see _lagged_gram) over the windows
+                 [p, n), [p, n-p) and [2p, n) (unused for p = 0)
+    @G0 - Gram over [0, n); S0, S1 - column sums over [0, n) and [p, n)
+    @sMRI - ridge added to the normal equations of Beta (as in wgr_glsco);
+            those solves are then not condition-guarded, as the dense
+            path solves the very same equations
+    Returns res_sum, Beta and whether each problem was solved (ok)
+    """
+    nvar = G0.shape[-1] - 1
+    if sMRI is None:
+        ridge, cond_max = 0., 1e8
+    else:
+        ridge, cond_max = sMRI, np.inf
+    Beta, ok = _solve_batch(G0[:, :nvar, :nvar] + ridge, G0[:, :nvar, nvar], cond_max)
+    if p == 0:
+        return _resid_var(G0, S0, Beta, nobs), Beta, ok
+    max_tol = np.minimum(1e-6, np.max(np.abs(Beta), axis=1) / 1000)
+    active = ok.copy()
+    for r in range(max_iter):
+        if not np.any(active):
+            break
+        Mw = Ma if r == 0 else Mb
+        c = np.append(-Beta[active], np.ones((np.sum(active), 1)), axis=1)
+        R = np.einsum('vi,vaibj,vj->vab', c, Mw[active], c)
+        AR_para, ok_ar = _solve_batch(R[:, 1:, 1:], R[:, 1:, 0])
+        # all-zero residuals: wgr_regress returns zero AR parameters
+        ok_ar |= np.all(R[:, 1:, 1:] == 0, axis=(1, 2))
+        alpha = np.append(np.ones((AR_para.shape[0], 1)), -AR_para, axis=1)
+        Gs = np.einsum('va,vaibj,vb->vij', alpha, M[active], alpha)
+        Beta_new, ok_b = _solve_batch(Gs[:, :nvar, :nvar] + ridge, Gs[:, :nvar, nvar], cond_max)
+        ind = np.where(active)[0]
+        ok[ind] &= ok_ar & ok_b
+        done = np.max(np.abs(Beta_new - Beta[ind]), axis=1) < max_tol[ind]
+        Beta[ind] = Beta_new
+        active[ind] = ~done & ok[ind]
+    return _resid_var(M[:, 0, :, 0, :], S1, Beta, nobs - p), Beta, ok
+
+def _lagged_gram(X, Y, p, start, stop):
+    """
+    M[..., a, :, b, :] = sum_{t=start}^{stop-1} Z[t-a] Z[t-b]^T, Z = [X, Y],
+    for the shifts a, b = 0..p (start >= p)
+    """
+    nvar = X.shape[-1]
+    batch = np.broadcast(X[..., 0, 0], Y[..., 0]).shape
+    M = np.zeros(batch + (p + 1, nvar + 1, p + 1, nvar + 1))
+    for a in range(p + 1):
+        Xa = X[..., start - a:stop - a, :]
+        Ya = Y[..., start - a:stop - a]
+        for b in range(a, p + 1):
+            Xb = X[..., start - b:stop - b, :]
+            Yb = Y[..., start - b:stop - b]
+            M[..., a, :nvar, b, :nvar] = np.matmul(np.swapaxes(Xa, -1, -2), Xb)
+            M[..., a, :nvar, b, nvar] = np.matmul(Yb[..., np.newaxis, :], Xa)[..., 0, :]
+            M[..., a, nvar, b, :nvar] = np.matmul(Ya[..., np.newaxis, :], Xb)[..., 0, :]
+            M[..., a, nvar, b, nvar] = np.einsum('...t,...t->...', Ya, Yb)
+            M[..., b, :, a, :] = np.swapaxes(M[..., a, :, b, :], -1, -2)
+    return M
+
+def _col_sums(X, Y, batch):
+    """
+    Column sums of Z = [X, Y], flattened over the batch
+    """
+    S = np.zeros(batch + (X.shape[-1] + 1,))
+    S[..., :-1] = X.sum(axis=-2)
+    S[..., -1] = Y.sum(axis=-1)
+    return S.reshape((-1, S.shape[-1]))
+
+def _solve_batch(A, b, cond_max=1e8):
+    """
+    Stacked solves of small normal equations; also returns which of the
+    systems were well-conditioned (the others are left at zero);
+    cond_max=np.inf only rejects the singular systems
+    """
+    x = np.zeros(b.shape)
+    if np.isinf(cond_max):
+        ok = np.ones(A.shape[0], dtype=bool)
+    else:
+        with np.errstate(all='ignore'):
+            ok = np.linalg.cond(A) < cond_max
+    if np.any(ok):
+        try:
+            x[ok] = np.linalg.solve(A[ok], b[ok][..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            for i in np.where(ok)[0]:
+                try:
+                    x[i] = np.linalg.solve(A[i], b[i])
+                except np.linalg.LinAlgError:
+                    ok[i] = False
+    return x, ok
+
+def _resid_var(G, S, Beta, nobs):
+    """
+    Residual variance (ddof=1) of Y - X * Beta from the Gram matrix G
+    and the column sums S of Z = [X, Y]
+    """
+    c = np.append(-Beta, np.ones((Beta.shape[0], 1)), axis=1)
+    ssq = np.einsum('vi,vij,vj->v', c, G, c)
+    sm = np.einsum('vi,vi->v', c, S)
+    return (ssq - sm ** 2 / nobs) / (nobs - 1)
+
+@functools.lru_cache(maxsize=None)
+def wgr_sFIR_prior(length, TR, fwhm=7):
+    """
+    Smoothness prior (inverse Gaussian covariance) of the sFIR
+    coefficients, (NN+1 x NN+1) with NN = floor(length/TR); it only
+    depends on its arguments, so it is built once per process and
+    returned read-only
+    @fwhm - smoothing in seconds (7 s - ref. Goutte)
+    """
+    NN = int(np.floor(length/TR))
+    nh = NN-1
+    dt = TR
+    _ = np.expand_dims(np.arange(1, nh+1).T, axis=1)
+    C = np.matmul(_,np.ones((1, nh)))
+    h = np.sqrt(1./(fwhm/dt))
+    v = 0.1
+    R = v * np.exp(-h/2 * (C-C.T)**2)
+    RI = linalg.inv(R)
+    MRI = np.zeros((nh + 1, nh + 1))
+    MRI[0:nh,0:nh] = RI
+    sigma = 1
+    sMRI0 = sigma**2*MRI
+    sMRI = np.zeros((NN+1, NN+1))
+    sMRI[0:NN,0:NN] = sMRI0
+    sMRI.setflags(write=False)
+    return sMRI
+
 def Fit_sFIR2(output, length, TR, input, T, flag_sfir, AR_lag):
     NN = int(np.floor(length/TR))
     _input = np.expand_dims(input[0], axis=0)
     X = linalg.toeplitz(input, np.concatenate((_input, np.zeros((1, NN-1))), axis = 1))
     X = np.concatenate((X, np.ones((input.shape))), axis = 1)
     if flag_sfir:
-        fwhm = 7 #fwhm=7 seconds smoothing - ref. Goutte
-        nh = NN-1
-        dt = TR
-        _ = np.expand_dims(np.arange(1, nh+1).T, axis=1)
-        C = np.matmul(_,np.ones((1, nh)))
-        h = np.sqrt(1./(fwhm/dt))
-        v = 0.1
-        R = v * np.exp(-h/2 * (C-C.T)**2)
-        RI = linalg.inv(R)
-        MRI = np.zeros((nh + 1, nh + 1))
-        MRI[0:nh,0:nh] = RI;
-        sigma = 1
-        sMRI0 = sigma**2*MRI
-        sMRI = np.zeros((NN+1, NN+1))
-        sMRI[0:NN,0:NN] = sMRI0; 
+        sMRI = wgr_sFIR_prior(length, TR)
         if AR_lag == 0:
             try:
                 hrf = linalg.solve((np.matmul(X.T,X)+sMRI),np.matmul(X.T,output))
@@ -120,7 +335,7 @@ def Fit_sFIR2(output, length, TR, input, T, flag_sfir, AR_lag):
             resid = output - np.matmul(X, hrf)
             res_sum = np.cov(resid)
         else:
-            res_sum, hrf = wgr_glsco(X,output,AR_lag=AR_lag,sMRI=sMRI);
+            res_sum, hrf = wgr_glsco_batch(X,output,AR_lag=AR_lag,sMRI=sMRI)
     else:
         if AR_lag == 0:
             hrf = linalg.lstsq(X,output)
@@ -128,7 +343,7 @@ def Fit_sFIR2(output, length, TR, input, T, flag_sfir, AR_lag):
             resid = output - np.matmul(X, hrf)
             res_sum = np.cov(resid)
         else:
-            res_sum, hrf = wgr_glsco(X,output,AR_lag=AR_lag)
+            res_sum, hrf = wgr_glsco_batch(X,output,AR_lag=AR_lag)
     return hrf, res_sum
 
 def wgr_FIR_estimation_HRF(u, dat, para, N):
@@ -158,4 +373,121 @@ def wgr_FIR_estimation_HRF(u, dat, para, N):
     if ind == np.amax(Cov_E.shape) - 1:
         ind = ind - 1
     rsH = hrf[:,ind+1]
-    return rsH, u
\ No newline at end of file
+    return rsH, u
+
+def wgr_FIR_lagged_gram(u, y, NN, lags, p, start, stop):
+    """
+    _lagged_gram of the (s)FIR designs X = [toeplitz(d), 1] (NN columns
+    + intercept) and Y = y, for the event trains d (ones at u - l, u >= l)
+    of every shift l in lags, computed from the event pairs instead of
+    the dense N x NN designs: the designs only differ by a shift, so
+    every Gram entry is a count of event pairs (or a sum of y at the
+    events) within a window that depends on the lag
+    @u - event indices; @y - BOLD signal (N)
+    Returns (nlag x p+1 x NN+2 x p+1 x NN+2)
+    """
+    u = np.unique(np.asarray(u, dtype=int))
+    lags = np.asarray(lags, dtype=int)
+    y = np.ravel(y)
+    N = y.shape[0]
+    nlag = lags.size
+    # column j of X at shift a is the event train at shift J = a + j
+    D = NN + p
+    J = np.arange(D)
+    lo = lags[:, None] + np.maximum(start - J, 0)[None, :]
+    hi = lags[:, None] + (stop - J)[None, :]
+    # X.1: events within the window (a contiguous range of u)
+    ilo = np.searchsorted(u, lo)
+    ihi = np.maximum(np.searchsorted(u, hi), ilo)
+    c = ihi - ilo
+    # X.X: pairs (e1, e1 + delta) of events with e1 within the window
+    # (both events past the lag), sorted by (delta, e1)
+    i1, i2 = np.nonzero(np.abs(u[None, :] - u[:, None]) < D)
+    off = D + p
+    big = N + np.max(lags, initial=0) + 2 * off + 1
+    key = np.sort((u[i2] - u[i1] + D) * big + u[i1] + off)
+    delta = J[:, None] - J[None, :]
+    lo2 = np.maximum(lo[:, :, None], lags[:, None, None] + np.maximum(-delta, 0))
+    hi2 = np.broadcast_to(hi[:, :, None], lo2.shape)
+    base = (delta + D) * big + off
+    F = np.maximum(np.searchsorted(key, base + hi2) - np.searchsorted(key, base + lo2), 0)
+    # X.y: sums of y[e + s] over the same ranges of events, s = J - l - b,
+    # from the cumulative sums over the events
+    s = np.arange(-np.max(lags, initial=0) - p, D)
+    t = u[:, None] + s[None, :]
+    Yu = np.where((t >= 0) & (t < N), y[np.clip(t, 0, N - 1)], 0)
+    P = np.concatenate((np.zeros((1, s.size)), np.cumsum(Yu, axis=0)))
+    XY = np.zeros((nlag, D, p + 1))
+    for b in range(p + 1):
+        col = J[None, :] - lags[:, None] - b - s[0]
+        XY[:, :, b] = P[ihi, col] - P[ilo, col]
+    M = np.zeros((nlag, p + 1, NN + 2, p + 1, NN + 2))
+    for a in range(p + 1):
+        ya = y[start - a:stop - a]
+        for b in range(p + 1):
+            yb = y[start - b:stop - b]
+            M[:, a, :NN, b, :NN] = F[:, a:a + NN, b:b + NN]
+            M[:, a, :NN, b, NN] = c[:, a:a + NN]
+            M[:, a, NN, b, :NN] = c[:, b:b + NN]
+            M[:, a, :NN, b, NN + 1] = XY[:, a:a + NN, b]
+            M[:, a, NN + 1, b, :NN] = XY[:, b:b + NN, a]
+            M[:, a, NN, b, NN] = stop - start
+            M[:, a, NN, b, NN + 1] = np.sum(yb)
+            M[:, a, NN + 1, b, NN] = np.sum(ya)
+            M[:, a, NN + 1, b, NN + 1] = np.dot(ya, yb)
+    return M
+
+def wgr_FIR_estimation_HRF_batch(event_bold, dat, para, N):
+    """
+    wgr_FIR_estimation_HRF for a block of voxels
+    @event_bold - event indices of each voxel
+    @dat - BOLD signals (N x nvox)
+    The designs of all lags are solved from their Gram matrices
+    (wgr_FIR_lagged_gram), all voxels and lags together; problems that
+    cannot be solved that way fall back to Fit_sFIR2.
+    Returns the HRFs (len_bin+1 x nvox)
+    """
+    dat = np.asarray(dat, dtype=float)
+    nvox = dat.shape[1]
+    firmode = para['estimation'] == 'sFIR'
+    nlag = np.amax(para['lag'].shape)
+    lags = np.arange(1, nlag + 1)
+    NN = int(np.floor(para['len'] / para['TR']))
+    p = para['AR_lag']
+    sMRI = wgr_sFIR_prior(para['len'], para['TR']) if firmode else None
+    # Gram windows: [0, N) for the first fit, [p, N), [p, N-p) and
+    # [2p, N) for the Cochrane-Orcutt iterations
+    windows = [(0, 0, N)]
+    if p > 0:
+        windows += [(p, p, N), (p, p, N - p), (p, 2 * p, N)]
+    grams = [np.zeros((nvox, nlag, q + 1, NN + 2, q + 1, NN + 2)) for q, _, _ in windows]
+    has_events = np.zeros((nvox, nlag), dtype=bool)
+    for j in range(nvox):
+        u = np.asarray(event_bold[j], dtype=int)
+        has_events[j] = np.any(u[None, :] >= lags[:, None], axis=1)
+        for G, (q, start, stop) in zip(grams, windows):
+            G[j] = wgr_FIR_lagged_gram(u, dat[:, j], NN, lags, q, start, stop)
+    grams = [G[has_events] for G in grams]
+    G0 = grams[0][:, 0, :, 0, :]
+    S0 = G0[:, NN, :]   # column sums: the intercept row of the Gram
+    M = Ma = Mb = S1 = None
+    if p > 0:
+        M, Ma, Mb = grams[1:]
+        S1 = M[:, 0, NN, 0, :]
+    res_sum, Beta, ok = _glsco_gram(M, Ma, Mb, G0, S0, S1, N, p, sMRI=sMRI)
+    hrf = np.zeros((nvox, nlag, NN + 1))
+    Cov_E = np.full((nvox, nlag), np.inf)
+    failed = np.zeros((nvox, nlag), dtype=bool)
+    hrf[has_events] = Beta
+    Cov_E[has_events] = res_sum
+    failed[has_events] = ~ok
+    for j, k in zip(*np.where(failed)):
+        RR = event_bold[j] - lags[k]
+        design = np.zeros((N, 1))
+        design[RR[RR >= 0]] = 1
+        hrf_kk, e3 = Fit_sFIR2(dat[:, j], para['len'], para['TR'], design, NN, firmode, p)
+        hrf[j, k] = np.ravel(hrf_kk)
+        Cov_E[j, k] = np.ravel(e3)[0]
+    ind = knee.knee_pt_batch(Cov_E)[1]
+    ind[ind == nlag - 1] -= 1
+    return hrf[np.arange(nvox), ind + 1].T
@@ -14,11 +14,12 @@ def spm_vol(input_file):
     return v
 
 
-def spm_read_vols(mapped_image_volume):
+def spm_read_vols(mapped_image_volume, dtype=np.float64):
     """
     Read in entire image volumes
+    @dtype - float64 or float32
     """
-    data = mapped_image_volume.get_fdata()
+    data = mapped_image_volume.get_fdata(dtype=dtype)
     data = data.flatten(order='F')
     return data
 
@@ -130,7 +131,7 @@ def spm_detrend(x, p=0):
     return y
 
 
-def spm_write_vol(image_volume_info, image_voxels, image_name, file_type):
+def spm_write_vol(image_volume_info, image_voxels, image_name, file_type, codec=None):
     """
     Writes an image volume to disk
 
@@ -139,7 +140,11 @@ def spm_write_vol(image_volume_info, image_voxels, image_name, file_type):
     @image_voxels - a one, two or three dimensional matrix
      containing the image voxels
     @image_name - name of the file to save the image in
+    @codec - utils.masked_volume.MaskedVolume; image_voxels are then the
+     values of the masked voxels only
     """
+    if codec is not None:
+        image_voxels = codec.unpack(image_voxels)
     if file_type == ".nii" or file_type == ".nii.gz":
         data = image_voxels
         affine = image_volume_info.affine
@@ -154,3 +159,79 @@ def spm_write_vol(image_volume_info, image_voxels, image_name, file_type):
         gi.add_gifti_data_array(data_array)
         # Use standard nibabel save function instead of deprecated giftiio.write
         nib.save(gi, image_name + file_type)
+
+
+def spm_vol_header(image_volume_info, shape, dtype=np.float32, slope=1., inter=0.):
+    """
+    NIfTI header of an image of the given shape and dtype, in the space
+    of image_volume_info (as spm_write_vol would write it), with the data
+    stored as data * slope + inter
+    """
+    hdr = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                          image_volume_info.affine).header
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    if slope != 1. or inter != 0.:
+        hdr.set_slope_inter(slope, inter)
+    hdr.set_data_offset(352)
+    return hdr
+
+
+def spm_write_vol_frames(image_volume_info, frames, shape, image_name, file_type,
+                         dtype=np.float32, slope=1., inter=0.):
+    """
+    Writes a 4D image volume frame by frame, so that at most one frame is
+    held in memory (NIfTI; GIFTI images are assembled in memory)
+    @frames - iterable of the shape[-1] frames (each of shape shape[:-1])
+    @dtype  - stored data type; integer types are scaled by slope and
+              inter (data = stored * slope + inter), rounded and clipped,
+              with NaNs stored as zeros
+    """
+    if not (file_type == ".nii" or file_type == ".nii.gz"):
+        spm_write_vol(image_volume_info, np.stack([np.array(frame) for frame in frames], axis=-1),
+                      image_name, file_type)
+        return
+    dtype = np.dtype(dtype)
+    hdr = spm_vol_header(image_volume_info, shape, dtype, slope, inter)
+    with nib.openers.Opener(image_name + file_type, 'wb') as f:
+        f.write(hdr.binaryblock)
+        f.write(b'\x00' * (352 - len(hdr.binaryblock)))
+        for frame in frames:
+            f.write(_scale_frame(frame, dtype, slope, inter).tobytes(order='F'))
+
+
+def spm_create_vol(image_volume_info, shape, image_name, dtype=np.float32):
+    """
+    Creates an uncompressed NIfTI image (.nii) of the given shape and
+    returns its data as a writable memory map (in F order), so that an
+    image can be written in pieces (e.g. slabs of voxels of all frames)
+    without being held in memory
+    """
+    dtype = np.dtype(dtype)
+    hdr = spm_vol_header(image_volume_info, shape, dtype)
+    with open(image_name + '.nii', 'wb') as f:
+        f.write(hdr.binaryblock)
+        f.write(b'\x00' * (352 - len(hdr.binaryblock)))
+        f.truncate(352 + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(image_name + '.nii', dtype=dtype, mode='r+', offset=352,
+                     shape=tuple(shape), order='F')
+
+
+def spm_scale_factor(amax, dtype):
+    """
+    Slope that stores values up to amax (in magnitude) in an integer
+    dtype; 1 for floating-point types
+    """
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer) or not amax > 0:
+        return 1.
+    return float(amax) / np.iinfo(dtype).max
+
+
+def _scale_frame(frame, dtype, slope=1., inter=0.):
+    frame = np.asarray(frame)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        # NaNs (e.g. constant voxels) are stored as zeros
+        frame = np.clip(np.round(np.nan_to_num((frame - inter) / slope)), info.min, info.max)
+    return frame.astype(dtype)
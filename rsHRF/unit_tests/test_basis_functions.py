@@ -1,3 +1,4 @@
+import os
 import pytest
 import numpy as np
 from ..basis_functions import basis_functions
@@ -27,4 +28,42 @@ def test_gamma_bf():
     assert basis_functions.gamma_bf(np.random.random(15), 11).shape == (15, 11)
     assert basis_functions.gamma_bf(np.random.random(15), 27).shape == (15, 27)
     assert np.allclose(basis_functions.gamma_bf(np.zeros(5), 7), np.zeros((5, 7)))
-    assert np.allclose(basis_functions.gamma_bf(np.ones(5), 3), np.asarray([[6.13132402e-02, 7.29919526e-05, 2.81323432e-13] for i in range(5)]))
\ No newline at end of file
+    assert np.allclose(basis_functions.gamma_bf(np.ones(5), 3), np.asarray([[6.13132402e-02, 7.29919526e-05, 2.81323432e-13] for i in range(5)]))
+
+def test_get_basis_function_cache(tmpdir):
+    para = {'estimation': 'canon2dd', 'TR': 2.0, 'T': 3, 'dt': 2.0 / 3, 'len': 24, 'order': 3, 'TD_DD': 2}
+    cache_dir = str(tmpdir.join('cache'))
+    basis_functions._BASIS_CACHE.clear()
+    bf = basis_functions.get_basis_function((100, 1), para, cache_dir)
+    assert not bf.flags.writeable
+    assert basis_functions.get_basis_function((100, 1), para) is bf
+    assert len(os.listdir(cache_dir)) == 1
+    basis_functions._BASIS_CACHE.clear()
+    assert np.array_equal(basis_functions.get_basis_function((100, 1), para, cache_dir), bf)
+    assert np.allclose(bf, basis_functions.compute_basis_function((100, 1), para))
+    basis_functions._BASIS_CACHE.clear()
+    para['estimation'] = 'gamma'
+    assert basis_functions.get_basis_function((100, 1), para, cache_dir).shape[1] == 3
+    assert len(os.listdir(cache_dir)) == 2
+    # a basis computed in-process without cache_dir is persisted by a later call with it
+    para['estimation'] = 'fourier'
+    bf = basis_functions.get_basis_function((100, 1), para)
+    assert len(os.listdir(cache_dir)) == 2
+    assert basis_functions.get_basis_function((100, 1), para, cache_dir) is bf
+    assert len(os.listdir(cache_dir)) == 3
+
+def test_wgr_basis_phases():
+    bf = np.random.random((10, 2))
+    phases = basis_functions.wgr_basis_phases(bf, 3)
+    assert phases.shape == (3, 5, 2)
+    assert np.array_equal(phases[1, :3], bf[[1, 4, 7]])
+    assert np.all(phases[1, 3:] == 0)
+
+def test_get_basis_phases():
+    bf = np.random.random((10, 2))
+    phases = basis_functions.get_basis_phases(bf, 3)
+    assert not phases.flags.writeable
+    assert np.array_equal(phases, basis_functions.wgr_basis_phases(bf, 3))
+    assert basis_functions.get_basis_phases(bf.copy(), 3) is phases
+    assert basis_functions.get_basis_phases(bf, 2) is not phases
+    assert basis_functions.get_basis_phases(bf + 1, 3) is not phases
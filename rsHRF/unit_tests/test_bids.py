@@ -0,0 +1,50 @@
+import os
+import json
+import numpy as np
+import nibabel as nib
+from bids.layout import BIDSLayout, parse_file_entities
+from ..utils import bids
+
+def _dataset(root, subjects):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'test', 'BIDSVersion': '1.4.0', 'DataType': 'derivative'}, f)
+    for sub in subjects:
+        func = os.path.join(root, 'sub-' + sub, 'func')
+        os.makedirs(func, exist_ok=True)
+        fname = os.path.join(func, 'sub-' + sub + '_task-rest_desc-preproc_bold.nii.gz')
+        nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 3), dtype=np.float32), np.eye(4)), fname)
+        with open(fname.replace('.nii.gz', '.json'), 'w') as f:
+            json.dump({'RepetitionTime': 2.}, f)
+
+def test_bids_layout_cache(tmpdir):
+    root, cache = os.path.join(str(tmpdir), 'data'), os.path.join(str(tmpdir), 'cache')
+    _dataset(root, ['01', '02'])
+    kwargs = dict(validate=False, config=['bids', 'derivatives'])
+    query = dict(return_type='filename', suffix='bold', extension=['nii', 'nii.gz'])
+    signature = bids.dataset_signature(root)
+    layout = bids.bids_layout(root, cache, **kwargs)
+    assert len(layout.get(**query)) == 2
+    database, = os.listdir(cache)
+    assert 'rsHRF_signature' in os.listdir(os.path.join(cache, database))
+    # reused as is when the dataset is unchanged
+    layout = bids.bids_layout(root, cache, **kwargs)
+    assert layout.get(**query) == BIDSLayout(root, **kwargs).get(**query)
+    assert layout.get_metadata(layout.get(**query)[0])['RepetitionTime'] == 2.
+    # rebuilt when a run is added
+    _dataset(root, ['03'])
+    assert bids.dataset_signature(root) != signature
+    layout = bids.bids_layout(root, cache, **kwargs)
+    assert len(layout.get(**query)) == 3
+    assert os.listdir(cache) == [database]
+
+def test_bids_output_paths(tmpdir):
+    out = str(tmpdir)
+    paths = bids.BIDSOutputPaths(out)
+    layout = BIDSLayout(out, validate=False)
+    for name in ['sub-01/func/sub-01_task-rest_desc-preproc_bold.nii.gz',
+                 'sub-02/ses-1/func/sub-02_ses-1_task-rest_run-2_desc-preproc_bold.nii']:
+        fname = os.path.join('/data', name)
+        expected = layout.build_path(parse_file_entities(fname))
+        assert paths.build_path(fname) == expected
+        assert paths.run_dir(fname) == expected.rsplit('/', 1)[0]
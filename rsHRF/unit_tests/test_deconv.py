@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+from ..processing import deconv
+
+def deconv_voxel(y, hrf):
+    nobs = y.shape[0]
+    H = np.fft.fft(np.append(hrf, np.zeros((nobs - max(hrf.shape), 1))), axis=0)
+    M = np.fft.fft(y)
+    return np.real(np.fft.ifft(H.conj() * M / (H * H.conj() + .1*np.mean((H * H.conj())))))
+
+@pytest.mark.parametrize('nobs, chunk_size', [(100, None), (101, 3), (64, 5000)])
+def test_fft_deconv(nobs, chunk_size):
+    nvar = 7
+    bold_sig = np.random.randn(nobs, nvar)
+    hrfa_TR = np.random.randn(17, nvar)
+    data_deconv = deconv.fft_deconv(bold_sig, hrfa_TR, chunk_size)
+    assert data_deconv.shape == (nobs, nvar)
+    for i in range(nvar):
+        assert np.allclose(data_deconv[:, i], deconv_voxel(bold_sig[:, i], hrfa_TR[:, i]))
+
+def test_fft_deconv_float32():
+    bold_sig = np.random.randn(80, 4).astype(np.float32)
+    hrfa_TR = np.random.randn(12, 4)
+    data_deconv = deconv.fft_deconv(bold_sig, hrfa_TR)
+    assert data_deconv.dtype == np.float32
+    assert np.allclose(data_deconv, deconv.fft_deconv(bold_sig.astype(float), hrfa_TR), atol=1e-4)
@@ -0,0 +1,181 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nib
+from .. import fourD_rsHRF
+
+def get_para(estimation):
+    para = {'estimation': estimation, 'passband': [0.01, 0.08], 'passband_deconvolve': [0.0, 1e308],
+            'TR': 2.0, 'T': 3, 'T0': 1, 'TD_DD': 2, 'AR_lag': 1, 'thr': 1, 'order': 3, 'len': 24,
+            'min_onset_search': 4, 'max_onset_search': 8, 'localK': 1}
+    if estimation == 'sFIR':
+        para['T'] = 1
+    para['dt'] = para['TR'] / para['T']
+    para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
+                            np.fix(para['max_onset_search'] / para['dt']) + 1,
+                            dtype='int')
+    return para
+
+def write_input(folder):
+    rng = np.random.RandomState(0)
+    data = 100 + rng.randn(5, 4, 6, 90)
+    data[0, 0] = 0
+    fname = os.path.join(folder, 'sub-01_task-rest_bold.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    mask = np.ones((5, 4, 6))
+    mask[1:3, 2] = 0
+    mask_fname = os.path.join(folder, 'mask.nii')
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_fname)
+    return fname, mask_fname
+
+@pytest.mark.parametrize('estimation, use_mask', [('canon2dd', False), ('canon2dd', True), ('sFIR', False)])
+def test_demo_rsHRF_stream(tmpdir, estimation, use_mask):
+    fname, mask_fname = write_input(str(tmpdir))
+    mask_file = mask_fname if use_mask else None
+    out_mem, out_stream = str(tmpdir.join('mem')), str(tmpdir.join('stream'))
+    fourD_rsHRF.demo_rsHRF(fname, mask_file, out_mem, get_para(estimation), 1, '.nii', mode='input')
+    fourD_rsHRF.demo_rsHRF(fname, mask_file, out_stream, get_para(estimation), 1, '.nii', mode='input',
+                           slab_size=50)
+    assert sorted(os.listdir(out_mem)) == sorted(os.listdir(out_stream))
+    for suffix in ['height', 'T2P', 'FWHM', 'eventnumber', 'deconv']:
+        exp = nib.load(os.path.join(out_mem, 'sub-01_task-rest_' + suffix + '.nii')).get_fdata()
+        res = nib.load(os.path.join(out_stream, 'sub-01_task-rest_' + suffix + '.nii')).get_fdata()
+        assert np.allclose(res, exp, equal_nan=True)
+
+def test_demo_rsHRF_mask_order(tmpdir):
+    # without a mask, the voxels with zero variance are left out
+    rng = np.random.RandomState(5)
+    data = rng.randn(3, 4, 2, 60)
+    flat = data.reshape((-1, 60), order='F')
+    flat[1:6] = 1.
+    data = flat.reshape(data.shape, order='F')
+    fname = os.path.join(str(tmpdir), 'sub-01_task-rest_bold.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    out = str(tmpdir.join('out'))
+    fourD_rsHRF.demo_rsHRF(fname, None, out, get_para('canon2dd'), 1, '.nii', mode='input')
+    deconv = nib.load(os.path.join(out, 'sub-01_task-rest_deconv.nii')).get_fdata()
+    analysed = np.any(deconv != 0, axis=-1)
+    # the constant voxels are those of F-order indices 1..5, i.e. (1..2,0,0),
+    # (0..2,1,0); the baseline took the variance in C order and left out
+    # C-order indices 1..5, i.e. (0,0,1), (0,1..2,0..1) instead
+    expected = np.ones((3, 4, 2), dtype=bool)
+    expected[np.unravel_index(np.arange(1, 6), (3, 4, 2), order='F')] = False
+    baseline = np.ones((3, 4, 2), dtype=bool)
+    baseline[np.unravel_index(np.arange(1, 6), (3, 4, 2), order='C')] = False
+    assert np.array_equal(analysed, expected)
+    assert not np.array_equal(analysed, baseline)
+
+def test_slab_bounds():
+    assert fourD_rsHRF.slab_bounds((5, 4, 6), 50) == [(0, 2), (2, 4), (4, 6)]
+    assert fourD_rsHRF.slab_bounds((5, 4, 6), 1) == [(z, z + 1) for z in range(6)]
+    assert fourD_rsHRF.slab_bounds((5, 4, 6), 10 ** 6) == [(0, 6)]
+
+@pytest.mark.parametrize('slab_size', [None, 50])
+def test_demo_rsHRF_float32(tmpdir, slab_size):
+    fname, mask_fname = write_input(str(tmpdir))
+    out64, out32 = str(tmpdir.join('float64')), str(tmpdir.join('float32'))
+    fourD_rsHRF.demo_rsHRF(fname, None, out64, get_para('canon2dd'), 1, '.nii', mode='input',
+                           slab_size=slab_size)
+    fourD_rsHRF.demo_rsHRF(fname, None, out32, get_para('canon2dd'), 1, '.nii', mode='input',
+                           slab_size=slab_size, dtype='float32')
+    for suffix in ['height', 'T2P', 'FWHM', 'deconv']:
+        img32 = nib.load(os.path.join(out32, 'sub-01_task-rest_' + suffix + '.nii'))
+        assert img32.get_data_dtype() == np.float32
+        exp = nib.load(os.path.join(out64, 'sub-01_task-rest_' + suffix + '.nii')).get_fdata()
+        res = img32.get_fdata()
+        assert np.allclose(res, exp, rtol=1e-3, atol=1e-3 * np.abs(exp).max())
+
+@pytest.mark.parametrize('slab_size', [None, 50])
+def test_demo_rsHRF_deconv_int16(tmpdir, slab_size):
+    fname, mask_fname = write_input(str(tmpdir))
+    out, out16 = str(tmpdir.join('float')), str(tmpdir.join('int16'))
+    fourD_rsHRF.demo_rsHRF(fname, mask_fname, out, get_para('canon2dd'), 1, '.nii', mode='input')
+    fourD_rsHRF.demo_rsHRF(fname, mask_fname, out16, get_para('canon2dd'), 1, '.nii', mode='input',
+                           slab_size=slab_size, deconv_dtype='int16')
+    assert not [f for f in os.listdir(out16) if f.endswith('.dat')]
+    img16 = nib.load(os.path.join(out16, 'sub-01_task-rest_deconv.nii'))
+    assert img16.get_data_dtype() == np.int16
+    exp = np.nan_to_num(nib.load(os.path.join(out, 'sub-01_task-rest_deconv.nii')).get_fdata())
+    assert np.allclose(img16.get_fdata(), exp, atol=np.abs(exp).max() / 32767)
+
+def test_demo_rsHRF_output_format(tmpdir):
+    fname, mask_fname = write_input(str(tmpdir))
+    out_mat, out_npz = str(tmpdir.join('mat')), str(tmpdir.join('npz'))
+    fourD_rsHRF.demo_rsHRF(fname, mask_fname, out_mat, get_para('canon2dd'), 1, '.nii', mode='input')
+    fourD_rsHRF.demo_rsHRF(fname, mask_fname, out_npz, get_para('canon2dd'), 1, '.nii', mode='input',
+                           output_format='npz')
+    load = fourD_rsHRF.utils.result_store.load_results
+    exp = load(os.path.join(out_mat, 'sub-01_task-rest_hrf.mat'))
+    res = load(os.path.join(out_npz, 'sub-01_task-rest_hrf.npz'), [0, 7])
+    assert np.allclose(res['hrfa'], exp['hrfa'][:, [0, 7]])
+    assert all(np.array_equal(a, b) for a, b in zip(res['event_bold'], exp['event_bold'][[0, 7]]))
+
+@pytest.mark.parametrize('backend, wiener', [('threads', False), ('processes', True)])
+def test_hrf_stages(backend, wiener):
+    para = get_para('canon2dd')
+    bold_sig = np.random.RandomState(1).randn(90, 20)
+    bf = fourD_rsHRF.basis_functions.basis_functions.get_basis_function(bold_sig.shape, para)
+    calls, timing = [], dict.fromkeys(fourD_rsHRF.STAGES, 0.)
+    res = fourD_rsHRF.hrf_stages(bold_sig.copy(), para, [], 2, bf, wiener, backend,
+                                 lambda stage, done, nvar: calls.append((stage, done, nvar)), timing)
+    exp = fourD_rsHRF.hrf_stages(bold_sig.copy(), para, [], 1, bf, wiener, 'serial')
+    for r, e in zip(res, exp):
+        if r.dtype == object:
+            assert all(np.array_equal(a, b) for a, b in zip(r, e))
+        else:
+            assert np.allclose(r, e)
+    assert [c for c in calls if c[1] == c[2]] == [(stage, 20, 20) for stage in fourD_rsHRF.STAGES]
+    assert all(timing[stage] > 0 for stage in fourD_rsHRF.STAGES)
+
+def test_retrieve_hrf_bands():
+    para = get_para('canon2dd')
+    bold_sig = fourD_rsHRF.stats.zscore(np.random.RandomState(2).randn(90, 6), ddof=1)
+    bf = fourD_rsHRF.basis_functions.basis_functions.get_basis_function(bold_sig.shape, para)
+    # default band: the z-scored signal is deconvolved as is
+    out = fourD_rsHRF.retrieve_hrf(bold_sig, para, [], 1, bf, 'serial')
+    assert np.array_equal(out[1], bold_sig)
+    para['passband_deconvolve'] = [0.0, 0.2]
+    out = fourD_rsHRF.retrieve_hrf(bold_sig, para, [], 1, bf, 'serial')
+    filt = fourD_rsHRF.processing.rest_filter.rest_IdealFilter
+    assert np.allclose(out[1], filt(bold_sig, para['TR'], para['passband_deconvolve']))
+    assert np.allclose(out[0], filt(bold_sig, para['TR'], para['passband']))
+
+def test_retrieve_hrf_baseline_deconv():
+    from .test_rest_filter import baseline_IdealFilter
+    para = get_para('canon2dd')
+    para['passband_deconvolve'] = [0.0, 0.2]
+    bold_sig = fourD_rsHRF.stats.zscore(np.random.RandomState(3).randn(90, 6), ddof=1)
+    bf = fourD_rsHRF.basis_functions.basis_functions.get_basis_function(bold_sig.shape, para)
+    out = fourD_rsHRF.retrieve_hrf(bold_sig, para, [], 1, bf, 'serial')
+    # baseline demo_rsHRF: the in-place filters made the deconvolution
+    # input the same array as the HRF estimation input, filtered with
+    # passband_deconvolve and then passband
+    x = bold_sig.copy()
+    base_deconv = baseline_IdealFilter(x, para['TR'], para['passband_deconvolve'])
+    base_sig = baseline_IdealFilter(x, para['TR'], para['passband'])
+    assert base_deconv is base_sig
+    # the HRF estimation input is unchanged (passband within passband_deconvolve)
+    assert np.allclose(out[0], base_sig)
+    # the deconvolution input is now filtered with passband_deconvolve only
+    assert np.allclose(out[1], fourD_rsHRF.processing.rest_filter.conn_filter(
+                       para['TR'], para['passband_deconvolve'], bold_sig))
+    assert not np.allclose(out[1], base_deconv)
+
+def test_retrieve_hrf_baseline_deconv_default_band():
+    from .test_rest_filter import baseline_IdealFilter
+    para = get_para('canon2dd')
+    bold_sig = fourD_rsHRF.stats.zscore(np.random.RandomState(4).randn(90, 6), ddof=1)
+    bf = fourD_rsHRF.basis_functions.basis_functions.get_basis_function(bold_sig.shape, para)
+    out = fourD_rsHRF.retrieve_hrf(bold_sig, para, [], 1, bf, 'serial')
+    # baseline demo_rsHRF with the default [0, inf] passband_deconvolve: the
+    # in-place filters made the deconvolution input the passband-filtered
+    # HRF estimation input
+    x = bold_sig.copy()
+    base_deconv = baseline_IdealFilter(x, para['TR'], para['passband_deconvolve'])
+    base_sig = baseline_IdealFilter(x, para['TR'], para['passband'])
+    assert base_deconv is base_sig
+    assert np.allclose(out[0], base_sig)
+    # the deconvolution input is now the z-scored signal itself (filtered
+    # with the all-pass passband_deconvolve only), not its passband filtering
+    assert np.array_equal(out[1], bold_sig)
+    assert not np.allclose(out[1], base_deconv)
@@ -0,0 +1,117 @@
+import pytest
+import numpy as np
+from ..utils import hrf_estimation
+from ..basis_functions import basis_functions
+from ..sFIR import smooth_fir
+
+def get_para(AR_lag=1):
+    para = {'estimation': 'canon2dd', 'passband': [0.01, 0.08], 'TR': 2.0, 'T': 3, 'T0': 1, 'TD_DD': 2, 'AR_lag': AR_lag, 'thr': 1, 'order': 3, 'len': 24, 'min_onset_search': 4, 'max_onset_search': 8, 'localK': 1, 'temporal_mask': []}
+    para['dt'] = para['TR'] / para['T']
+    para['lag'] = np.arange(np.fix(para['min_onset_search'] / para['dt']),
+                            np.fix(para['max_onset_search'] / para['dt']) + 1,
+                            dtype='int')
+    return para
+
+def get_data(N=120, nvar=9, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(N, nvar)
+
+@pytest.mark.parametrize('AR_lag', [0, 1])
+def test_compute_hrf_batch(AR_lag):
+    para = get_para(AR_lag)
+    bold_sig = get_data()
+    N, nvar = bold_sig.shape
+    bf = basis_functions.get_basis_function(bold_sig.shape, para)
+    beta_hrf, event_bold = hrf_estimation.compute_hrf(bold_sig, para, [], 1, bf=bf, chunk_size=4)
+    assert beta_hrf.shape == (bf.shape[1] + 2, nvar)
+    assert event_bold.shape == (nvar,)
+    for i in range(nvar):
+        beta_exp, u_exp = hrf_estimation.estimate_hrf(bold_sig, i, para, N, bf)
+        assert np.allclose(beta_hrf[:, i], beta_exp)
+        assert np.array_equal(event_bold[i], u_exp)
+
+@pytest.mark.parametrize('backend', ['processes', 'threads', 'serial'])
+def test_compute_hrf_backend(backend):
+    para = get_para()
+    bold_sig = get_data()
+    bf = basis_functions.get_basis_function(bold_sig.shape, para)
+    beta_exp, event_exp = hrf_estimation.compute_hrf(bold_sig, para, [], 1, bf=bf, chunk_size=4)
+    beta_hrf, event_bold = hrf_estimation.compute_hrf(bold_sig, para, [], 2, bf=bf, chunk_size=4,
+                                                      backend=backend)
+    assert np.allclose(beta_hrf, beta_exp)
+    for u, u_exp in zip(event_bold, event_exp):
+        assert np.array_equal(u, u_exp)
+
+@pytest.mark.parametrize('T, T0', [(3, 1), (3, 3), (1, 1), (16, 8)])
+def test_wgr_onset_design_lags(T, T0):
+    nscans = 50
+    bf = np.random.random((37, 3))
+    u = np.zeros(nscans * T)
+    u[np.random.choice(u.size, 8, replace=False)] = np.random.random(8)
+    lag = np.arange(0, 15)
+    X = hrf_estimation.wgr_onset_design_lags(u, bf, lag, T, T0, nscans)
+    assert X.shape == (lag.size, nscans, bf.shape[1])
+    for i, l in enumerate(lag):
+        u_lag = np.append(u[l:], np.zeros(l))
+        X_exp = np.array([np.convolve(u_lag, bf[:, p])[:u.size] for p in range(bf.shape[1])]).T
+        X_exp = X_exp[(np.arange(0, nscans) * T) + (T0 - 1), :]
+        assert np.allclose(X[i], X_exp)
+    assert np.allclose(hrf_estimation.wgr_onset_design(u, bf, T, T0, nscans), X[0])
+
+@pytest.mark.parametrize('AR_lag', [0, 1, 2])
+def test_wgr_glm_estimation_batch(AR_lag):
+    para = get_para(AR_lag)
+    bold_sig = get_data(nvar=3)
+    N = bold_sig.shape[0]
+    bf = basis_functions.get_basis_function(bold_sig.shape, para)
+    u = np.zeros(N * para['T'])
+    u[np.random.choice(N, 12, replace=False) * para['T']] = 1
+    x = hrf_estimation.wgr_onset_design_lags(u, bf, para['lag'], para['T'], para['T0'], N)
+    x[-1] = 0
+    erm, beta = hrf_estimation.wgr_glm_estimation_batch(bold_sig.T[:, np.newaxis, :], x, AR_lag)
+    assert erm.shape == (3, para['lag'].size)
+    assert beta.shape == (3, para['lag'].size, bf.shape[1] + 1)
+    for j in range(3):
+        for i in range(para['lag'].size):
+            X = np.append(x[i], np.ones((N, 1)), axis=1)
+            erm_exp, beta_exp = smooth_fir.wgr_glsco(X, bold_sig[:, j], AR_lag=AR_lag)
+            assert np.allclose(erm[j, i], erm_exp)
+            assert np.allclose(beta[j, i], beta_exp)
+
+def test_wgr_glm_fit_voxels():
+    bold_sig = get_data(nvar=4)
+    x = np.random.random((bold_sig.shape[0], 3))
+    erm, beta = hrf_estimation.wgr_glm_fit(bold_sig, x, 1)
+    assert erm.shape == (4,) and beta.shape == (4, 4)
+    for j in range(4):
+        erm_exp, beta_exp = hrf_estimation.wgr_glm_fit(bold_sig[:, j], x, 1)
+        assert np.allclose(erm[j], erm_exp)
+        assert np.allclose(beta[j], beta_exp)
+
+@pytest.mark.parametrize('k, thr, masked', [(1, 1, False), (2, 0.5, False), (1, 1, True)])
+def test_wgr_BOLD_event_matrix(k, thr, masked):
+    N = 150
+    bold_sig = get_data(N, 40) * np.random.random(40) * 5
+    bold_sig[:, 3] = 0
+    temporal_mask = [int(m) for m in np.random.random(N) > 0.2] if masked else []
+    events = hrf_estimation.wgr_BOLD_event_matrix(N, bold_sig, [thr], k, list(temporal_mask))
+    assert events.shape == (40, N)
+    for j in range(40):
+        u = hrf_estimation.wgr_BOLD_event_vector(N, bold_sig[:, j], [thr], k, list(temporal_mask))
+        assert np.array_equal(events.indices[events.indptr[j]:events.indptr[j + 1]],
+                              u.toarray()[0].nonzero()[0])
+
+@pytest.mark.parametrize('estimation', ['FIR', 'sFIR'])
+def test_compute_hrf_fir(estimation):
+    para = get_para(1)
+    para['estimation'] = estimation
+    para['T'] = 1
+    para['thr'] = np.array([1, np.inf])
+    bold_sig = get_data(nvar=4)
+    N = bold_sig.shape[0]
+    beta_hrf, event_bold = hrf_estimation.compute_hrf(bold_sig, para, [], 1, chunk_size=3)
+    assert beta_hrf.shape == (int(para['len'] / para['TR']) + 1, 4)
+    for i in range(4):
+        beta_exp, u_exp = hrf_estimation.estimate_hrf(bold_sig, i, para, N)
+        assert np.allclose(beta_hrf[:, i], beta_exp)
+        assert np.array_equal(event_bold[i], u_exp)
@@ -421,6 +421,50 @@ def test_output_is_real():
     assert out.dtype in [np.float32, np.float64]
 
 
+# ============================================================================
+# BATCHED (MULTI-VOXEL) DECONVOLUTION
+# ============================================================================
+
+@pytest.mark.parametrize("N, TR, Mode, Tol", [
+    (150, 2.0, 'rest', 1e-4),
+    (151, 0.72, 'task', 1e-2),
+    (64, 0.5, 'rest', 1e-3),
+    (9, None, 'rest', 1e-4),
+])
+def test_batch_matches_single_voxel(N, TR, Mode, Tol):
+    """Batched deconvolution matches the per-voxel one, whatever the iteration each voxel stops at"""
+    nvar = 6
+    y = np.random.randn(N, nvar)
+    h = np.random.random((min(20, N - 2), nvar))
+
+    out = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv_batch(
+        y, h, TR=TR, Mode=Mode, Tol=Tol
+    )
+
+    assert out.shape == (N, nvar)
+    for i in range(nvar):
+        expected = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv(
+            y[:, i], h[:, i], TR=TR, Mode=Mode, Tol=Tol
+        )
+        assert np.allclose(out[:, i], expected)
+
+
+def test_batch_shared_hrf():
+    """A single HRF is used for all the signals"""
+    y = np.random.randn(100, 4)
+    h = np.random.random(12)
+
+    out = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv_batch(
+        y, h, TR=2.0, MaxIter=20, Smooth=4, LowPass=0.1
+    )
+
+    for i in range(4):
+        expected = iterative_wiener_deconv.rsHRF_iterative_wiener_deconv(
+            y[:, i], h, TR=2.0, MaxIter=20, Smooth=4, LowPass=0.1
+        )
+        assert np.allclose(out[:, i], expected)
+
+
 if __name__ == "__main__":
     # Run all tests
     pytest.main([__file__, "-v"])
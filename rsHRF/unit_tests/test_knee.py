@@ -15,4 +15,15 @@ def test_knee_pt():
     y = np.asarray([(0.13638490363348788+0.4483173781686369j), (0.21565052592551615+0.5219779191597427j), (0.9979379796276104+0.07548834892584189j), (0.29470166952920507+0.36391228981190515j), (0.3464996550382653+0.0014059490581040945j), (0.4641546533051284+0.06567864084007502j), (0.46315096641592435+0.3323511950388086j), (0.17130338335642903+0.9791635674939458j), (0.9625869976661646+0.5830153856154539j), (0.8588617152267485+0.6576125931014645j)])
     out1, out2 = knee.knee_pt(y)
     assert out1 == 6
-    assert out2 == 0
\ No newline at end of file
+    assert out2 == 0
+
+@pytest.mark.parametrize('nlag', [2, 3, 9, 25])
+def test_knee_pt_batch(nlag):
+    y = np.random.random((40, nlag))
+    y[:10] = np.round(y[:10] * 3)
+    y[10:12] = 0
+    res_x, idx = knee.knee_pt_batch(y)
+    for j in range(40):
+        out1, out2 = knee.knee_pt(y[j])
+        assert res_x[j] == out1
+        assert idx[j] == out2
@@ -0,0 +1,29 @@
+import pytest
+import numpy as np
+from ..utils.masked_volume import MaskedVolume
+
+def test_masked_volume():
+    shape = (4, 5, 3)
+    brain = np.random.random(shape) - 0.3
+    codec = MaskedVolume.from_mask(brain.flatten(order='F'), shape, np.eye(4))
+    voxel_ind = np.where(brain.flatten(order='F') > 0)[0]
+    assert np.array_equal(codec.voxel_ind, voxel_ind)
+    assert codec.nmask == voxel_ind.size
+    data = np.random.random(shape + (7,))
+    exp = np.reshape(data, (-1, 7), order='F').T[:, voxel_ind]
+    assert np.array_equal(codec.pack(data), exp)
+    assert np.array_equal(codec.pack(np.ascontiguousarray(data)), exp)
+    vol = codec.unpack(exp[2])
+    assert vol.shape == shape
+    assert np.array_equal(vol.flatten(order='F')[voxel_ind], exp[2])
+    assert np.all(vol.flatten(order='F')[brain.flatten(order='F') <= 0] == 0)
+    vols = codec.unpack(exp, dtype=np.float32)
+    assert vols.shape == shape + (7,) and vols.dtype == np.float32
+    frames = [frame.copy() for frame in codec.frames(exp)]
+    assert np.allclose(np.stack(frames, axis=-1), vols)
+
+def test_masked_volume_surface():
+    codec = MaskedVolume([0, 3, 4], (6,))
+    data = np.arange(12.).reshape(6, 2)
+    assert np.array_equal(codec.pack(data), data[[0, 3, 4]].T)
+    assert np.array_equal(codec.unpack([1., 2., 3.]), [1., 0, 0, 2., 3., 0])
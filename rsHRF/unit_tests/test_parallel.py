@@ -0,0 +1,68 @@
+import os
+import pytest
+import numpy as np
+from joblib import Parallel, delayed
+from ..utils import parallel
+
+def _sum_block(context, a, b):
+    scale = context
+    return [scale * (a + b), a[:1]], list(range(a.shape[1]))
+
+def test_map_voxel_chunks(tmpdir):
+    rng = np.random.RandomState(0)
+    a = rng.randn(5, 11)
+    fname = os.path.join(str(tmpdir), 'b.dat')
+    b = np.memmap(fname, dtype='float32', mode='w+', shape=(5, 11), order='F')
+    b[:] = rng.randn(5, 11)
+    b.flush()
+    for p_jobs in [1, 2]:
+        (out, first), extras = parallel.map_voxel_chunks(
+            _sum_block, [a, b], [5, 1], p_jobs, context=2.,
+            chunk_size=4, temp_folder=str(tmpdir))
+        assert out.shape == (5, 11) and first.shape == (1, 11)
+        assert np.allclose(out, 2. * (a + b))
+        assert np.allclose(first, a[:1])
+        assert [len(e) for e in extras] == [4, 4, 3]
+    assert sorted(os.listdir(str(tmpdir))) == ['b.dat']
+
+def _mapped_files(folder):
+    # mapped files of the process within folder (deleted ones included)
+    with open('/proc/self/maps') as f:
+        return [line for line in f if folder in line]
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='needs /proc')
+def test_map_voxel_chunks_releases_maps(tmpdir):
+    a = np.random.RandomState(0).randn(5, 40)
+    parallel.map_voxel_chunks(_sum_block, [a, a], [5, 1], 2, context=1.,
+                              chunk_size=4, temp_folder=str(tmpdir))
+    # the workers of the (reused) pool keep no file of the call mapped
+    mapped = Parallel(n_jobs=2)(delayed(_mapped_files)(str(tmpdir)) for i in range(8))
+    assert not any(mapped)
+
+@pytest.mark.parametrize('backend', ['threads', 'serial'])
+def test_map_voxel_chunks_in_memory(backend):
+    rng = np.random.RandomState(0)
+    a, b = rng.randn(5, 11), rng.randn(5, 11)
+    (out, first), extras = parallel.map_voxel_chunks(
+        _sum_block, [a, b], [5, 1], 2, context=2., chunk_size=4, backend=backend)
+    assert np.allclose(out, 2. * (a + b))
+    assert np.allclose(first, a[:1])
+    assert [len(e) for e in extras] == [4, 4, 3]
+
+def test_map_voxel_chunks_backend():
+    with pytest.raises(ValueError):
+        parallel.map_voxel_chunks(_sum_block, [np.zeros((2, 2))] * 2, [2], 1,
+                                  backend='gpu')
+
+def test_voxel_chunk_size():
+    assert parallel.voxel_chunk_size(10, 1) == 3
+    assert parallel.voxel_chunk_size(10 ** 6, 4) == 128
+    assert parallel.voxel_chunk_size(1, 8) == 1
+
+def test_blas_limits_notice(monkeypatch, capsys):
+    monkeypatch.setattr(parallel, 'threadpool_limits', None)
+    monkeypatch.setattr(parallel._blas_limits, 'reported', False)
+    for i in range(2):
+        with parallel._blas_limits(2):
+            pass
+    assert capsys.readouterr().out.count('threadpoolctl is not installed') == 1
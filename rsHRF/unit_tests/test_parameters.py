@@ -8,4 +8,16 @@ def test_wgr_get_parameters():
     assert np.allclose(parameters.wgr_get_parameters(np.zeros(np.random.randint(1, 100)), np.random.uniform(0, 5)), np.zeros(3))
     dt = np.random.uniform(0, 5)
     assert np.allclose(parameters.wgr_get_parameters(np.ones(np.random.randint(100)), dt), np.asarray([1., dt, dt]))
-    assert np.allclose(parameters.wgr_get_parameters(np.asarray([0.54353434, 0.39763409, 0.92579636, 0.74797229, 0.89733085]), 0.1), np.asarray([0.92579636, 0.3, 0.1]))
\ No newline at end of file
+    assert np.allclose(parameters.wgr_get_parameters(np.asarray([0.54353434, 0.39763409, 0.92579636, 0.74797229, 0.89733085]), 0.1), np.asarray([0.92579636, 0.3, 0.1]))
+
+def test_wgr_get_parameters_batch():
+    dt = 0.5
+    for nbins in [2, 5, 33]:
+        hdrf = np.random.randn(nbins, 50)
+        hdrf[:, :10] = np.round(hdrf[:, :10]) * 0.0005    # flat gradients before the peak
+        hdrf[:, 10:15] = np.random.random((1, 5))         # constant HRFs
+        hdrf[:, 15] = 0
+        PARA = parameters.wgr_get_parameters_batch(hdrf, dt)
+        assert PARA.shape == (3, 50)
+        for i in range(50):
+            assert np.array_equal(PARA[:, i], parameters.wgr_get_parameters(hdrf[:, i], dt))
@@ -24,4 +24,49 @@ def test_rest_IdealFilter():
     assert np.allclose(y, np.zeros((152, 1)))
     x = np.ones((152, 1))
     y = rest_filter.rest_IdealFilter(x, TR, filter)
-    assert np.allclose(y, np.ones((152, 1)))
\ No newline at end of file
+    assert np.allclose(y, np.ones((152, 1)))
+
+def test_rest_IdealFilter_bands():
+    TR = 2.0
+    bands = [[0.01, 0.08], [0, np.inf]]
+    x = np.random.random((152, 7))
+    x0 = x.copy()
+    out = rest_filter.rest_IdealFilter_bands(x, TR, bands, m=3)
+    assert np.array_equal(x, x0)
+    assert len(out) == 2
+    for band, y in zip(bands, out):
+        assert np.allclose(y, rest_filter.conn_filter(TR, band, x) + np.mean(x, axis=0))
+        assert np.allclose(y, rest_filter.rest_IdealFilter(x, TR, band))
+    assert rest_filter.wgr_band_mask(152, TR, 0.01, 0.08) is rest_filter.wgr_band_mask(152, TR, 0.01, 0.08)
+
+def baseline_IdealFilter(x, TR, Bands, m=5000):
+    # rest_IdealFilter before the DCT rewrite: filters x in place and adds
+    # back one mean per block of m voxels
+    for start in range(0, x.shape[1], m):
+        x1 = x[:, start:start + m]
+        x[:, start:start + m] = rest_filter.conn_filter(TR, Bands, x1) + np.mean(x1)
+    return x
+
+def test_rest_IdealFilter_baseline():
+    TR = 2.0
+    filter = [0.01, 0.08]
+    rng = np.random.RandomState(0)
+    # zero-mean (e.g. z-scored) columns: same output as the baseline
+    x = rng.randn(152, 7)
+    x -= np.mean(x, axis=0)
+    assert np.allclose(rest_filter.rest_IdealFilter(x, TR, filter, m=3),
+                       baseline_IdealFilter(x.copy(), TR, filter, m=3))
+    # otherwise each column gets its own mean back, where the baseline
+    # added the mean of its block of m voxels to all of them
+    x = rng.randn(152, 7) + np.arange(7)
+    x0 = x.copy()
+    y = rest_filter.rest_IdealFilter(x, TR, filter, m=3)
+    assert np.array_equal(x, x0)
+    assert np.allclose(y, rest_filter.conn_filter(TR, filter, x) + np.mean(x, axis=0))
+    assert not np.allclose(y, baseline_IdealFilter(x.copy(), TR, filter, m=3))
+
+def test_wgr_is_allpass():
+    assert rest_filter.wgr_is_allpass(152, 2.0, [0, np.inf])
+    assert rest_filter.wgr_is_allpass(152, 2.0, [0.0, 1.7976931348623157e+308])
+    assert not rest_filter.wgr_is_allpass(152, 2.0, [0.01, 0.08])
+    assert not rest_filter.wgr_is_allpass(152, 2.0, [0, 0.2])
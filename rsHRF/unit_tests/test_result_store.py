@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+from ..utils import result_store
+
+def get_results(nvar=5):
+    para = {'estimation': 'canon2dd', 'TR': 2.0, 'passband': [0.01, 0.08], 'lag': np.arange(3, 9),
+            'thr': np.asarray([1., np.inf]), 'temporal_mask': []}
+    event_bold = np.empty(nvar, dtype=object)
+    for j in range(nvar):
+        event_bold[j] = np.sort(np.random.choice(100, j * 2, replace=False))
+    return {'para': para, 'hrfa': np.random.random((37, nvar)), 'event_bold': event_bold,
+            'PARA': np.random.random((3, nvar)), 'event_number': np.arange(nvar)[np.newaxis, :] * 2.}
+
+def test_events_to_csr():
+    event_bold = get_results()['event_bold']
+    indices, offsets = result_store.events_to_csr(event_bold)
+    assert offsets.tolist() == [0, 0, 2, 6, 12, 20]
+    events = result_store.csr_to_events(indices, offsets)
+    assert all(np.array_equal(a, b) for a, b in zip(events, event_bold))
+    assert np.array_equal(result_store.csr_to_events(indices, offsets, [3])[0], event_bold[3])
+
+@pytest.mark.parametrize('output_format', ['mat', 'npz', 'hdf5', 'zarr'])
+def test_save_load_results(tmpdir, output_format):
+    if output_format == 'hdf5' and result_store.h5py is None:
+        pytest.skip('needs h5py')
+    elif output_format == 'zarr' and result_store.zarr is None:
+        pytest.skip('needs zarr<3')
+    dic = get_results()
+    path = result_store.save_results(str(tmpdir.join('sub-01_hrf')), dic, output_format)
+    assert path.endswith(result_store.EXTENSIONS[output_format])
+    for voxels in [None, [4, 1]]:
+        res = result_store.load_results(path, voxels)
+        cols = slice(None) if voxels is None else [1, 4]
+        for key in ('hrfa', 'PARA', 'event_number'):
+            assert np.allclose(res[key], dic[key][:, cols])
+        events = dic['event_bold'][cols]
+        assert len(res['event_bold']) == len(events)
+        assert all(np.array_equal(a, b) for a, b in zip(res['event_bold'], events))
+    if output_format != 'mat':
+        assert res['para']['lag'] == dic['para']['lag'].tolist()
+        assert res['para']['estimation'] == 'canon2dd'
+
+def test_save_results_format():
+    with pytest.raises(ValueError):
+        result_store.save_results('results', get_results(), 'csv')
+
+def test_save_results_requires(tmpdir, monkeypatch):
+    monkeypatch.setattr(result_store, 'zarr', None)
+    with pytest.raises(ImportError, match='zarr<3'):
+        result_store.save_results(str(tmpdir.join('sub-01_hrf')), get_results(), 'zarr')
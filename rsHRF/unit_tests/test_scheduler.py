@@ -0,0 +1,71 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nib
+from ..utils import scheduler, parallel
+
+def _square(x, fail=False):
+    if fail:
+        raise ValueError('bad run %d' % x)
+    return x * x, parallel.cpu_budget()
+
+def _abort(x):
+    os._exit(1)
+
+def test_split_jobs():
+    assert scheduler.split_jobs(10, 8) == (8, 1)
+    assert scheduler.split_jobs(2, 8) == (2, 4)
+    assert scheduler.split_jobs(3, 8) == (3, 2)
+    assert scheduler.split_jobs(10, 8, run_jobs=2) == (2, 4)
+    assert scheduler.split_jobs(10, 1) == (1, 1)
+    assert scheduler.split_jobs(0, 4) == (1, 4)
+
+def test_available_memory(tmpdir):
+    meminfo = os.path.join(str(tmpdir), 'meminfo')
+    with open(meminfo, 'w') as f:
+        f.write('MemTotal:       16000000 kB\nMemFree:          500000 kB\n'
+                'MemAvailable:    9000000 kB\nCached:          8000000 kB\n')
+    assert scheduler.available_memory(meminfo) == 9000000 * 1024
+    # without MemAvailable, the free pages
+    fallback = scheduler.available_memory(os.path.join(str(tmpdir), 'missing'))
+    assert fallback is None or fallback > 0
+
+def test_admit():
+    memory = [4, 4, 1, 8]
+    assert scheduler._admit([0, 1, 2, 3], memory, 0, 0, 3, None) == [0, 1, 2]
+    assert scheduler._admit([0, 1, 2, 3], memory, 0, 0, 4, 6) == [0, 2]
+    assert scheduler._admit([1, 3], memory, 1, 5, 4, 6) == []
+    # a run larger than the bound still starts when nothing else runs
+    assert scheduler._admit([3], memory, 0, 0, 4, 6) == [3]
+
+@pytest.mark.parametrize('run_jobs', [1, 2])
+def test_map_runs(run_jobs):
+    runs = [((i,), {'fail': i == 2}) for i in range(5)]
+    done = []
+    results, errors = scheduler.map_runs(_square, runs, run_jobs, memory=[1] * 5,
+                                         max_memory=2, cores_per_run=1,
+                                         progress=lambda d, n: done.append((d, n)))
+    assert [r if r is None else r[0] for r in results] == [0, 1, None, 9, 16]
+    assert errors == [(2, 'ValueError: bad run 2')]
+    assert done[-1] == (5, 5)
+    if run_jobs > 1:
+        assert all(r[1] == 1 for r in results if r is not None)
+
+def test_map_runs_worker_crash():
+    runs = [((0,), {}), ((1,), {}), ((2,), {})]
+    results, errors = scheduler.map_runs(_abort, runs[:1], 2)
+    assert results == [None] and len(errors) == 1
+    results, errors = scheduler.map_runs(_square, runs, 2)
+    assert [r[0] for r in results] == [0, 1, 4] and errors == []
+
+def test_run_memory(tmpdir):
+    data = np.zeros((4, 5, 6, 10), dtype=np.int16)
+    mask = np.zeros((4, 5, 6), dtype=np.uint8)
+    mask[:2] = 1
+    fname, mname = os.path.join(str(tmpdir), 'bold.nii'), os.path.join(str(tmpdir), 'mask.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mname)
+    copies = scheduler.RUN_COPIES
+    assert scheduler.run_memory(fname, mname) == 10 * (copies * 60 * 8 + 120 * 8)
+    assert scheduler.run_memory(fname, None, 'float32') == 10 * (copies * 120 * 4 + 120 * 4)
+    assert scheduler.run_memory(fname, mname, slab_size=30) == 10 * (copies * 60 * 8 + 30 * 8)
@@ -1,5 +1,6 @@
 import pytest
 import numpy as np 
+from scipy import linalg
 from ..sFIR import smooth_fir 
 
 def test_wgr_regress():
@@ -88,4 +89,75 @@ def test_wgr_FIR_estimation_HRF():
     assert type(out2) == type(np.asarray([]))
     assert np.allclose(out1, np.zeros((13)))
     out2_exp = np.array([0.82657439, 0.45718164, 0.91678174, 0.64977718, 0.68731705, 0.45801904, 0.74586124])
-    assert np.allclose(out2_exp ,out2) 
\ No newline at end of file
+    assert np.allclose(out2_exp ,out2)
+
+def test_wgr_regress_batch():
+    X = np.random.random((6, 40, 4))
+    X[2, :, 1] = 0
+    X[4, :, 3] = X[4, :, 0]
+    Y = np.random.random((6, 40))
+    out = smooth_fir.wgr_regress_batch(Y, X)
+    assert out.shape == (6, 4)
+    for i in range(6):
+        assert np.allclose(out[i], smooth_fir.wgr_regress(Y[i], X[i]))
+
+def test_wgr_sFIR_prior():
+    length, TR = 24, 0.72
+    sMRI = smooth_fir.wgr_sFIR_prior(length, TR)
+    NN = int(np.floor(length / TR))
+    assert sMRI.shape == (NN + 1, NN + 1)
+    assert not sMRI.flags.writeable
+    assert smooth_fir.wgr_sFIR_prior(length, TR) is sMRI
+    t = np.arange(1, NN)
+    R = 0.1 * np.exp(-np.sqrt(TR / 7.) / 2 * (t[:, np.newaxis] - t) ** 2)
+    assert np.allclose(np.dot(sMRI[:NN - 1, :NN - 1], R), np.eye(NN - 1), atol=1e-6)
+    assert np.all(sMRI[NN - 1:] == 0) and np.all(sMRI[:, NN - 1:] == 0)
+
+def test_wgr_FIR_lagged_gram():
+    N, NN, p = 60, 6, 2
+    u = np.asarray([0, 3, 4, 10, 17, 18, 30, 41, 55, 59])
+    y = np.random.random(N)
+    lags = np.arange(1, 5)
+    M = smooth_fir.wgr_FIR_lagged_gram(u, y, NN, lags, p, p, N - 1)
+    for k, lag in enumerate(lags):
+        design = np.zeros((N, 1))
+        design[u[u >= lag] - lag] = 1
+        X = np.concatenate((linalg.toeplitz(design, np.zeros((1, NN))), np.ones((N, 1))), axis=1)
+        assert np.allclose(M[k], smooth_fir._lagged_gram(X, y, p, p, N - 1))
+
+def test_wgr_FIR_estimation_HRF_batch():
+    N, nvox = 120, 5
+    dat = np.random.randn(N, nvox)
+    event_bold = [np.sort(np.random.choice(N, 12, replace=False)) for j in range(nvox)]
+    event_bold[1] = np.asarray([0, 1], dtype=int)
+    for estimation, AR_lag in [('sFIR', 1), ('FIR', 0), ('FIR', 2)]:
+        para = {'estimation': estimation, 'TR': 2.0, 'len': 24, 'AR_lag': AR_lag,
+                'lag': np.arange(4, 10)}
+        out = smooth_fir.wgr_FIR_estimation_HRF_batch(event_bold, dat, para, N)
+        assert out.shape == (13, nvox)
+        for j in range(nvox):
+            rsH = smooth_fir.wgr_FIR_estimation_HRF(event_bold[j], dat[:, j], para, N)[0]
+            assert np.allclose(out[:, j], rsH)
+
+@pytest.mark.parametrize('AR_lag', [0, 1, 2])
+def test_wgr_glsco_batch_sMRI(AR_lag):
+    length, TR, N = 24, 2.0, 100
+    NN = int(np.floor(length / TR))
+    sMRI = smooth_fir.wgr_sFIR_prior(length, TR)
+    X = np.append(np.random.random((4, N, NN)), np.ones((4, N, 1)), axis=2)
+    Y = np.random.random((4, N))
+    res_sum, Beta = smooth_fir.wgr_glsco_batch(X, Y, AR_lag=AR_lag, sMRI=sMRI)
+    for i in range(4):
+        res_exp, Beta_exp = smooth_fir.wgr_glsco(X[i], Y[i], sMRI=sMRI, AR_lag=AR_lag)
+        assert np.allclose(res_sum[i], res_exp)
+        assert np.allclose(Beta[i], Beta_exp)
+
+def test_wgr_regress_fast_path():
+    X = np.random.random((50, 4))
+    y = np.random.random(50)
+    assert smooth_fir._wgr_regress_chol(y, X) is not None
+    assert np.allclose(smooth_fir.wgr_regress(y, X), smooth_fir._wgr_regress_qr(y, X))
+    # rank-deficient designs fall back to the pivoted QR
+    X[:, 3] = X[:, 0] + X[:, 1]
+    assert smooth_fir._wgr_regress_chol(y, X) is None
+    assert np.allclose(smooth_fir.wgr_regress(y, X), smooth_fir._wgr_regress_qr(y, X))
@@ -94,4 +94,24 @@ def test_spm_write_vol():
             if 'gii' in file_type:
                 file_type = '.gii'
             assert os.path.isfile(fname + file_type)
-            os.remove(fname + file_type)
\ No newline at end of file
+            os.remove(fname + file_type)
+
+def test_spm_write_vol_frames(tmpdir):
+    v1 = nib.Nifti1Image(np.zeros((3, 4, 5, 6)), np.diag([2., 2., 3., 1.]))
+    data = np.random.randn(3, 4, 5, 6)
+    fname = str(tmpdir.join('frames'))
+    spm.spm_write_vol_frames(v1, (data[..., i] for i in range(6)), data.shape, fname, '.nii.gz')
+    img = nib.load(fname + '.nii.gz')
+    assert np.allclose(img.affine, v1.affine)
+    assert np.allclose(img.get_fdata(), data.astype(np.float32))
+    slope = spm.spm_scale_factor(np.abs(data).max(), np.int16)
+    spm.spm_write_vol_frames(v1, (data[..., i] for i in range(6)), data.shape, fname, '.nii',
+                             dtype=np.int16, slope=slope)
+    img = nib.load(fname + '.nii')
+    assert img.get_data_dtype() == np.int16
+    assert np.allclose(img.get_fdata(), data, atol=slope)
+    vol = spm.spm_create_vol(v1, data.shape, str(tmpdir.join('created')))
+    vol[:, :, :2] = data[:, :, :2]
+    vol[:, :, 2:] = data[:, :, 2:]
+    del vol
+    assert np.allclose(nib.load(str(tmpdir.join('created.nii'))).get_fdata(), data.astype(np.float32))
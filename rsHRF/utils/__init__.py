@@ -1,2 +1,6 @@
 from . import hrf_estimation
-from . import bids 
\ No newline at end of file
+from . import bids
+from . import parallel
+from . import masked_volume
+from . import result_store
+from . import scheduler
@@ -2,7 +2,14 @@
 import os
 import sys
 import json
+import hashlib
+import tempfile
 from pathlib import Path
+from bids.layout import BIDSLayout, parse_file_entities
+from bids.layout.models import Config
+from bids.layout.writing import build_path
+from bids_validator import BIDSValidator
+from bids.exceptions import BIDSValidationError
 
 def write_derivative_description(bids_dir, deriv_dir):
     from ..__about__ import __version__, DOWNLOAD_URL
@@ -51,3 +58,81 @@ def write_derivative_description(bids_dir, deriv_dir):
         desc['License'] = orig_desc['License']
 
     Path.write_text(deriv_dir / 'dataset_description.json', json.dumps(desc, indent=4))
+
+
+def dataset_signature(bids_dir):
+    """
+    Hash of the modification times of the directories of the dataset (that
+    change when files are added, removed or renamed) and of its JSON
+    sidecars (the indexed metadata); hidden directories are skipped
+    """
+    sha = hashlib.sha1()
+    stack = [os.path.abspath(bids_dir)]
+    while stack:
+        path = stack.pop()
+        sha.update(('%s %d\n' % (path, os.stat(path).st_mtime_ns)).encode())
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.name.endswith('.json'):
+                sha.update(('%s %d\n' % (entry.path, entry.stat().st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+def bids_layout(bids_dir, cache_dir=None, **kwargs):
+    """
+    BIDSLayout of bids_dir (kwargs as in BIDSLayout)
+    @cache_dir - directory of the persistent index: the pybids database of
+                 the layout is stored there and reused by later invocations,
+                 until the dataset_signature of bids_dir changes
+    """
+    if cache_dir is None:
+        return BIDSLayout(bids_dir, **kwargs)
+    key = json.dumps([os.path.abspath(bids_dir), kwargs], sort_keys=True, default=str)
+    database_path = os.path.join(cache_dir, 'rsHRF_layout_' +
+                                 hashlib.sha1(key.encode()).hexdigest())
+    signature_file = os.path.join(database_path, 'rsHRF_signature')
+    signature = dataset_signature(bids_dir)
+    try:
+        with open(signature_file) as f:
+            reset = f.read() != signature
+    except OSError:
+        reset = True
+    layout = BIDSLayout(bids_dir, database_path=database_path, reset_database=reset, **kwargs)
+    if reset:
+        # written once the index is complete, atomically
+        fd, tmp = tempfile.mkstemp(dir=database_path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(signature)
+        os.replace(tmp, signature_file)
+    return layout
+
+class BIDSOutputPaths(object):
+    """
+    Output paths of BIDS inputs under output_dir, as
+    BIDSLayout(output_dir).build_path, from the path patterns of the BIDS
+    configuration (output_dir is not indexed). Built once per invocation
+    and shared by the runs.
+    """
+    def __init__(self, output_dir, config='bids'):
+        self.root = os.path.abspath(output_dir)
+        self.path_patterns = list(Config.load(config).default_path_patterns)
+
+    def build_path(self, source):
+        """
+        Output path of an input file (or of a dictionary of entities)
+        """
+        entities = parse_file_entities(source) if isinstance(source, str) else source
+        built = build_path(entities, self.path_patterns)
+        if built is None:
+            raise ValueError('Unable to construct build path with source {}'.format(source))
+        if not BIDSValidator().is_bids(os.path.join(os.path.sep, built)):
+            raise BIDSValidationError('Built path {} is not a valid BIDS filename'.format(built))
+        return os.path.join(self.root, built)
+
+    def run_dir(self, input_file):
+        """
+        Output directory of the results of an input file
+        """
+        return self.build_path(input_file).rsplit('/', 1)[0]
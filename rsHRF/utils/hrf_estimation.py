@@ -1,13 +1,10 @@
-import os
-import shutil
-import tempfile
 import numpy as np
 from scipy        import stats
-from scipy.sparse import lil_matrix
-from joblib       import load, dump
-from joblib       import Parallel, delayed
+from scipy.sparse import lil_matrix, csr_matrix
 from rsHRF        import processing, sFIR
 from ..processing import knee
+from ..basis_functions import basis_functions
+from .            import parallel
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -16,21 +13,40 @@ warnings.filterwarnings("ignore")
 HRF ESTIMATION
 """
 
-def compute_hrf(bold_sig, para, temporal_mask, p_jobs, bf = None):
+def compute_hrf(bold_sig, para, temporal_mask, p_jobs, bf = None, chunk_size = None,
+                temp_folder = None, backend = 'processes', progress = None):
+    """
+    Estimate HRF of all voxels, in parallel blocks of chunk_size voxels
+    @temp_folder - where the memory-mapped signal/results are kept
+    @backend - 'processes', 'threads' or 'serial' (see utils.parallel)
+    @progress - called as progress(done, nvar) as blocks of voxels complete
+    """
     para['temporal_mask'] = temporal_mask
     N, nvar = bold_sig.shape
-    folder = tempfile.mkdtemp()
-    data_folder = os.path.join(folder, 'data')
-    dump(bold_sig, data_folder)
-    data = load(data_folder, mmap_mode='r')
-    results = Parallel(n_jobs=p_jobs)(delayed(estimate_hrf)(data, i, para,
-                                  N, bf) for i in range(nvar))
-    beta_hrf, event_bold = zip(*results)
-    try:
-        shutil.rmtree(folder)
-    except:
-        print("Failed to delete: " + folder)
-    return np.array(beta_hrf).T, np.array(event_bold)
+    if bf is not None:
+        nrows = bf.shape[1] + 2
+    else:
+        nrows = int(np.floor(para['len'] / para['TR'])) + 1
+    (beta_hrf,), event_bold = parallel.map_voxel_chunks(
+        _estimate_block, [bold_sig], [nrows], p_jobs, context=(para, bf),
+        chunk_size=chunk_size, temp_folder=temp_folder, backend=backend,
+        progress=progress)
+    return beta_hrf, _event_array([u for block in event_bold for u in block])
+
+def _estimate_block(context, dat):
+    para, bf = context
+    beta_hrf, event_bold = estimate_hrf_batch(dat, np.arange(dat.shape[1]),
+                                              para, dat.shape[0], bf)
+    return [beta_hrf], event_bold
+
+def _event_array(event_bold):
+    """
+    Ragged per-voxel event indices as a 1-D object array
+    """
+    events = np.empty(len(event_bold), dtype=object)
+    for i, u in enumerate(event_bold):
+        events[i] = u
+    return events
 
 def estimate_hrf(bold_sig, i, para, N, bf = None):
     """
@@ -55,6 +71,27 @@ def estimate_hrf(bold_sig, i, para, N, bf = None):
         u = u0.toarray()[0].nonzero()[0]
     return beta_hrf, u
 
+def estimate_hrf_batch(bold_sig, ind, para, N, bf = None):
+    """
+    Estimate HRF of a block of voxels
+    @ind - indices of the voxels (columns of bold_sig)
+    The block is estimated in double precision, whatever the dtype of bold_sig
+    """
+    dat = np.asarray(bold_sig[:, ind], dtype=float)
+    nvox = dat.shape[1]
+    thr = np.ravel(para['thr']) #only the lower threshold is used for (s)FIR
+    events = wgr_BOLD_event_matrix(N, dat, thr, para['localK'], para['temporal_mask'])
+    event_bold = [events.indices[events.indptr[j]:events.indptr[j + 1]]
+                  for j in range(nvox)]
+    if para['estimation'] == 'sFIR' or para['estimation'] == 'FIR':
+        beta_hrf = sFIR.smooth_fir.wgr_FIR_estimation_HRF_batch(event_bold, dat, para, N)
+    else:
+        u = np.zeros((nvox, N * para['T']))
+        for j in range(nvox):
+            u[j, event_bold[j] * para['T']] = 1
+        beta_hrf = wgr_hrf_fit_batch(dat, para, u, bf)
+    return beta_hrf, event_bold
+
 def wgr_onset_design(u, bf, T, T0, nscans):
     """
     @u - BOLD event vector (microtime).
@@ -62,19 +99,40 @@ def wgr_onset_design(u, bf, T, T0, nscans):
     @T - microtime resolution (number of time bins per scan)
     @T0 - microtime onset (reference time bin, see slice timing)
     """
-    ind = np.arange(0, max(u.shape))
-    X = np.empty((0, len(ind)))
-    for p in range(bf.shape[1]):
-        x = np.convolve(u, bf[:, p])
-        x = x[ind]
-        X = np.append(X, [x], axis=0)
-    X = X.T
+    return wgr_onset_design_lags(u, bf, [0], T, T0, nscans)[0]
+
+def wgr_onset_design_lags(u, bf, lag, T, T0, nscans, phases=None):
     """
-    Resample regressors at acquisition times
+    Onset designs of every lag in one call, built as sums of shifted
+    copies of the basis set at the (sparse) onsets of u
+    @u   - BOLD event vector (microtime).
+    @lag - shifts of the event vector (microtime bins)
+    @phases - basis_functions.get_basis_phases(bf, T), when already at hand
+    Returns the regressors resampled at acquisition times
+    (nlag x nscans x nbf)
     """
-    X = X[(np.arange(0, nscans) * T) + (T0 - 1), :]
-    return X
-
+    if phases is None:
+        phases = basis_functions.get_basis_phases(bf, T)
+    u = np.ravel(u)
+    ons = np.nonzero(u)[0]
+    lag = np.ravel(lag).astype(int)
+    nbf = bf.shape[1]
+    nlag = lag.size
+    # onset (for each lag) relative to the first acquisition time bin:
+    # it adds the basis at phase r of its first scan j to scans j, j+1, ...
+    shift = ons[np.newaxis, :] - lag[:, np.newaxis] - (T0 - 1)
+    j = -(-shift // T)
+    r = np.broadcast_to((j * T - shift)[:, :, np.newaxis], j.shape + (phases.shape[1],))
+    m = np.broadcast_to(np.arange(phases.shape[1]), r.shape)
+    j = j[:, :, np.newaxis] + m
+    valid = (j >= 0) & (j < nscans) & (ons >= lag[:, np.newaxis])[:, :, np.newaxis]
+    w = np.broadcast_to(u[ons][np.newaxis, :, np.newaxis], valid.shape)[valid]
+    rows = (j + nscans * np.arange(nlag)[:, np.newaxis, np.newaxis])[valid]
+    contrib = phases[r[valid], m[valid]]
+    X = np.zeros((nlag * nscans, nbf))
+    for p in range(nbf):
+        X[:, p] = np.bincount(rows, weights=w * contrib[:, p], minlength=nlag * nscans)
+    return X.reshape((nlag, nscans, nbf))
 
 def wgr_glm_estimation(dat, u, bf, T, T0, AR_lag):
     """
@@ -82,8 +140,16 @@ def wgr_glm_estimation(dat, u, bf, T, T0, AR_lag):
     """
     nscans = dat.shape[0]
     x = wgr_onset_design(u, bf, T, T0, nscans)
+    return wgr_glm_fit(dat, x, AR_lag)
+
+def wgr_glm_fit(dat, x, AR_lag):
+    """
+    @dat - BOLD signal (nscans), or signals sharing the design (nscans x nvox)
+    @x - onset design (nscans x nbf), without the constant term
+    """
+    nscans = dat.shape[0]
     X = np.append(x, np.ones((nscans, 1)), axis=1)
-    res_sum, Beta = sFIR.smooth_fir.wgr_glsco(X, dat, AR_lag=AR_lag)
+    res_sum, Beta = sFIR.smooth_fir.wgr_glsco_batch(X, np.asarray(dat).T, AR_lag=AR_lag)
     return np.real(res_sum), Beta
 
 def wgr_hrf_fit(dat, xBF, u, bf):
@@ -96,10 +162,9 @@ def wgr_hrf_fit(dat, xBF, u, bf):
     nlag = len(lag)
     erm = np.zeros((1, nlag))
     beta = np.zeros((bf.shape[1] + 1, nlag))
-    for i in range(nlag):
-        u_lag = np.append(u[0, lag[i]:], np.zeros((1, lag[i]))).T
-        erm[0, i], beta[:, i] = \
-            wgr_glm_estimation(dat, u_lag, bf, xBF['T'], xBF['T0'], AR_lag)
+    x = wgr_onset_design_lags(u, bf, lag, xBF['T'], xBF['T0'], dat.shape[0])
+    erm[0], beta = wgr_glm_estimation_batch(dat, x, AR_lag)
+    beta = beta.T
     x, idx = knee.knee_pt(np.ravel(erm))
     if idx == nlag-1:
         idx = idx - 1
@@ -107,6 +172,42 @@ def wgr_hrf_fit(dat, xBF, u, bf):
     beta_hrf = np.append(beta_hrf, lag[idx+1])
     return beta_hrf
 
+def wgr_glm_estimation_batch(dat, x, AR_lag):
+    """
+    Lag sweep: GLM fits of the designs of all lags at once
+    @dat - BOLD signal (... x nscans), shared by the designs of its lags
+    @x   - onset designs (... x nlag x nscans x nbf), without the constant term
+    The Gram matrices are formed once per lag (the signal part once per
+    voxel) and the AR(p) Cochrane-Orcutt iterations run on them, instead
+    of refitting each lag from its full design.
+    """
+    nscans, nbf = x.shape[-2:]
+    X = np.ones(x.shape[:-1] + (nbf + 1,))
+    X[..., :-1] = x
+    res_sum, Beta = sFIR.smooth_fir.wgr_glsco_batch(X, dat, AR_lag=AR_lag)
+    return np.real(res_sum), Beta
+
+def wgr_hrf_fit_batch(dat, xBF, u, bf):
+    """
+    wgr_hrf_fit for a block of voxels
+    @dat - BOLD signals (nscans x nvox)
+    @u   - BOLD event vectors (nvox x microtime)
+    """
+    lag = xBF['lag']
+    nlag = len(lag)
+    nscans, nvox = dat.shape
+    x = np.zeros((nvox, nlag, nscans, bf.shape[1]))
+    phases = basis_functions.get_basis_phases(bf, xBF['T'])
+    for j in range(nvox):
+        x[j] = wgr_onset_design_lags(u[j], bf, lag, xBF['T'], xBF['T0'], nscans, phases)
+    erm, beta = wgr_glm_estimation_batch(dat.T[:, np.newaxis, :], x, xBF['AR_lag'])
+    _, idx = knee.knee_pt_batch(erm)
+    idx[idx == nlag-1] -= 1
+    beta_hrf = np.zeros((bf.shape[1] + 2, nvox))
+    beta_hrf[:-1] = beta[np.arange(nvox), idx+1].T
+    beta_hrf[-1] = np.asarray(lag)[idx+1]
+    return beta_hrf
+
 def wgr_BOLD_event_vector(N, matrix, thr, k, temporal_mask):
     """
     Detect BOLD event.
@@ -138,3 +239,38 @@ def wgr_BOLD_event_vector(N, matrix, thr, k, temporal_mask):
                         np.all(matrix[t - 1, 0] > matrix[t:t + k, 0]):
                     data[0, t - 1] = 1.
     return data
+
+def wgr_BOLD_event_matrix(N, matrix, thr, k, temporal_mask):
+    """
+    Detect BOLD events of all voxels at once (see wgr_BOLD_event_vector).
+    @matrix - BOLD signals (N x nvar)
+    Returns a (nvar x N) CSR matrix: the events of voxel j are
+    indices[indptr[j]:indptr[j + 1]].
+    """
+    matrix = np.nan_to_num(np.reshape(matrix, (N, -1)))
+    nvar = matrix.shape[1]
+    # one contiguous row per voxel, so that the reductions below match
+    # the single-voxel ones bit for bit
+    matrix = np.ascontiguousarray(matrix.T)
+    t = np.arange(k, N - k)
+    if 0 in np.array(temporal_mask).shape:
+        matrix = stats.zscore(matrix, axis=1, ddof=1)
+        keep = np.ones(t.shape, dtype=bool)
+    else:
+        # time points outside the mask are replaced by the first one
+        # in the mean/std, as in wgr_BOLD_event_vector
+        mask = np.ravel(temporal_mask) != 0
+        ind = np.where(mask, np.arange(N), 0)
+        datm = np.mean(matrix[:, ind], axis=1, keepdims=True)
+        datstd = np.std(matrix[:, ind], axis=1, keepdims=True)
+        datstd[datstd == 0] = 1
+        matrix = (matrix - datm) / datstd
+        keep = mask[t]
+    peak = matrix[:, t]
+    event = (peak > thr[0]) & keep
+    for d in range(1, k + 1):
+        event &= (matrix[:, t - d] < peak) & (peak > matrix[:, t + d])
+    rows, cols = np.nonzero(event)
+    indptr = np.zeros(nvar + 1, dtype=int)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=nvar))
+    return csr_matrix((np.ones(rows.size), t[cols], indptr), shape=(nvar, N))
@@ -0,0 +1,61 @@
+"""Packing of masked voxels to and from image volumes."""
+import numpy as np
+
+class MaskedVolume(object):
+    """
+    The voxels of a mask within an image (a NIfTI volume or a GIfTI
+    surface), with the F-order voxel indices used throughout rsHRF.
+    Volumes are packed to (nobs x nmask) signals and masked values are
+    unpacked to volumes with a single scatter, without flattening and
+    reshaping the whole volume.
+    @voxel_ind - F-order indices of the voxels within the mask
+    @shape     - spatial shape of the image
+    @affine    - voxel-to-world affine of the image (None for surfaces)
+    """
+    def __init__(self, voxel_ind, shape, affine=None):
+        self.voxel_ind = np.asarray(voxel_ind, dtype=int)
+        self.shape = tuple(int(n) for n in shape)
+        self.affine = affine
+        # the voxel coordinates, for direct indexing of the volumes
+        self.coords = np.unravel_index(self.voxel_ind, self.shape, order='F')
+
+    @classmethod
+    def from_mask(cls, brain, shape, affine=None):
+        """
+        Voxels where the (F-order flattened) mask data is positive
+        """
+        return cls(np.where(np.ravel(brain, order='F') > 0)[0], shape, affine)
+
+    @property
+    def nmask(self):
+        return self.voxel_ind.size
+
+    def pack(self, data):
+        """
+        Signals of the masked voxels (nobs x nmask) of a 4D volume
+        (shape x nobs); only the masked voxels are copied
+        """
+        return np.asarray(data[self.coords]).T
+
+    def unpack(self, values, dtype=None, fill=0, out=None):
+        """
+        Volume(s) with the values of the masked voxels
+        @values - (nmask), or (k x nmask) for k volumes (shape x k)
+        @out    - preallocated volume(s) to scatter into (only the masked
+                  voxels are written)
+        """
+        values = np.asarray(values)
+        if out is None:
+            dtype = values.dtype if dtype is None else dtype
+            out = np.full(self.shape + values.shape[:-1][::-1], fill, dtype=dtype)
+        out[self.coords] = values.T
+        return out
+
+    def frames(self, data, dtype=np.float64):
+        """
+        The volumes of the signals (nobs x nmask), one at a time in a
+        single reused buffer
+        """
+        frame = np.zeros(self.shape, dtype=dtype)
+        for i in range(data.shape[0]):
+            yield self.unpack(data[i], out=frame)
@@ -0,0 +1,228 @@
+"""Chunked parallel execution over voxels."""
+import os
+import shutil
+import functools
+import tempfile
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs, load, dump
+from joblib import parallel_backend, cpu_count
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+BACKENDS = ('processes', 'threads', 'serial')
+
+# cores available to this process (None: all of them); lowered in the
+# worker processes of runs processed concurrently (utils.scheduler)
+_CPU_BUDGET = {'cores': None}
+
+# file names and context of the last call, loaded once per worker process
+# (the memory maps themselves are opened per block)
+_WORKER_STATE = {}
+
+def set_cpu_budget(n_cores):
+    """
+    Limits the cores shared by the voxel workers and their BLAS threads
+    in this process (None: all the cores)
+    """
+    _CPU_BUDGET['cores'] = None if n_cores is None else max(int(n_cores), 1)
+
+def cpu_budget():
+    if _CPU_BUDGET['cores'] is None:
+        return cpu_count()
+    return _CPU_BUDGET['cores']
+
+def voxel_chunk_size(nvar, p_jobs, max_size=128):
+    """
+    Voxels per block: a few blocks per worker, bounded to keep
+    the per-block work arrays small
+    """
+    n_workers = effective_n_jobs(p_jobs)
+    return int(min(max(np.ceil(nvar / (4. * n_workers)), 1), max_size))
+
+def blas_threads(p_jobs, backend='processes'):
+    """
+    BLAS threads per worker, so that workers x threads matches the cores
+    """
+    if backend == 'serial':
+        return cpu_budget()
+    return max(cpu_budget() // effective_n_jobs(p_jobs), 1)
+
+class _blas_limits(object):
+    """
+    Limits the BLAS/OpenMP threads of this process (needs threadpoolctl,
+    otherwise the limits are left to the environment, with a notice)
+    """
+    # whether the missing threadpoolctl was reported
+    reported = False
+
+    def __init__(self, n_threads):
+        self.n_threads = n_threads
+        self.limiter = None
+
+    def __enter__(self):
+        if threadpool_limits is not None:
+            self.limiter = threadpool_limits(limits=self.n_threads)
+        elif not _blas_limits.reported:
+            _blas_limits.reported = True
+            print('threadpoolctl is not installed: the BLAS threads are not limited to ' +
+                  str(self.n_threads) + ' per worker and may oversubscribe the cores '
+                  '(pip install threadpoolctl, or set OMP_NUM_THREADS)')
+        return self
+
+    def __exit__(self, *args):
+        if self.limiter is not None:
+            self.limiter.restore_original_limits()
+
+def map_voxel_chunks(func, inputs, outputs, p_jobs, context=None,
+                     chunk_size=None, max_chunk_size=128, temp_folder=None,
+                     backend='processes', n_blas_threads=None, dtype=float,
+                     progress=None):
+    """
+    Runs func over contiguous blocks of voxels in parallel.
+    @func    - module-level function called as
+               func(context, *input_blocks) -> (output_blocks, extra)
+    @inputs  - 2-D arrays with the voxels along the columns; an np.memmap
+               is handed to the workers as is, anything else is written
+               once to temp_folder and memory-mapped
+    @outputs - number of rows of each result array (nrows x nvar)
+    @context - objects shared by all blocks (e.g. para, bf); stored once
+               in temp_folder and loaded once per worker (the memory-mapped
+               arrays are reopened for each block, so that idle workers do
+               not keep the removed files mapped)
+    @temp_folder - directory for the memory-mapped arrays (default: a new
+               temporary directory, removed on return)
+    @backend - 'processes' (memory-mapped arrays shared with worker
+               processes), 'threads' (arrays shared in memory; the batched
+               numpy/scipy work releases the GIL) or 'serial'
+    @n_blas_threads - BLAS threads per worker (default: cores / workers)
+    @dtype   - dtype of the result arrays
+    @progress - called as progress(done, nvar) as the blocks complete
+    Returns the preallocated result arrays, filled in place by the workers,
+    and the list of the per-block extras (in voxel order).
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: ' + str(backend) +
+                         ', choose from ' + ', '.join(BACKENDS))
+    if backend == 'serial':
+        p_jobs = 1
+    nvar = inputs[0].shape[1]
+    if chunk_size is None:
+        chunk_size = voxel_chunk_size(nvar, p_jobs, max_chunk_size)
+    bounds = [(i, min(i + chunk_size, nvar)) for i in range(0, nvar, chunk_size)]
+    if n_blas_threads is None:
+        n_blas_threads = blas_threads(p_jobs, backend)
+    if backend != 'processes':
+        return _map_in_memory(func, inputs, outputs, p_jobs, context,
+                              bounds, n_blas_threads, dtype, progress)
+    folder = tempfile.mkdtemp(dir=temp_folder)
+    try:
+        input_files = []
+        for i, x in enumerate(inputs):
+            if isinstance(x, np.memmap) and x.filename is not None and x.ndim == 2:
+                input_files.append((x.filename, x.dtype.str, x.shape, x.offset,
+                                    'F' if np.isfortran(x) else 'C'))
+            else:
+                fname = os.path.join(folder, 'input_%d.npy' % i)
+                np.save(fname, x)
+                input_files.append(fname)
+        # results are stored voxel-major, so that each block is contiguous
+        output_files = []
+        for i, nrows in enumerate(outputs):
+            fname = os.path.join(folder, 'output_%d.npy' % i)
+            np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                      shape=(nvar, nrows))
+            output_files.append(fname)
+        dump((input_files, output_files, context),
+             os.path.join(folder, 'state'))
+        with parallel_backend('loky', inner_max_num_threads=n_blas_threads):
+            extras = _map_chunks(functools.partial(_run_chunk, func, folder),
+                                 bounds, p_jobs, None, progress)
+        results = [np.array(np.load(fname, mmap_mode='r').T) for fname in output_files]
+    finally:
+        _WORKER_STATE.clear()
+        try:
+            shutil.rmtree(folder)
+        except:
+            print("Failed to delete: " + folder)
+    return results, extras
+
+def _map_chunks(run_chunk, bounds, p_jobs, backend, progress):
+    """
+    Runs run_chunk(start, stop) over the blocks, a few blocks per worker
+    at a time, so that the progress can be reported in between
+    """
+    nvar = bounds[-1][1] if bounds else 0
+    extras = []
+    if effective_n_jobs(p_jobs) == 1:
+        for start, stop in bounds:
+            extras.append(run_chunk(start, stop))
+            if progress is not None:
+                progress(stop, nvar)
+        return extras
+    batch = 8 * effective_n_jobs(p_jobs)
+    with Parallel(n_jobs=p_jobs, backend=backend) as parallel:
+        for i in range(0, len(bounds), batch):
+            extras.extend(parallel(delayed(run_chunk)(start, stop)
+                                   for start, stop in bounds[i:i + batch]))
+            if progress is not None:
+                progress(bounds[min(i + batch, len(bounds)) - 1][1], nvar)
+    return extras
+
+def _map_in_memory(func, inputs, outputs, p_jobs, context, bounds, n_blas_threads,
+                   dtype=float, progress=None):
+    """
+    Threads and serial runs: the blocks are views of the inputs and the
+    results are written directly into the returned arrays
+    """
+    nvar = inputs[0].shape[1]
+    results = [np.zeros((nrows, nvar), dtype=dtype) for nrows in outputs]
+
+    def run_chunk(start, stop):
+        out_blocks, extra = func(context, *[np.asarray(x[:, start:stop]) for x in inputs])
+        for out, block in zip(results, out_blocks):
+            out[:, start:stop] = block
+        return extra
+
+    with _blas_limits(n_blas_threads):
+        extras = _map_chunks(run_chunk, bounds, p_jobs, 'threading', progress)
+    return results, extras
+
+def _worker_state(folder):
+    """
+    The file names and the context of a call, loaded once per process
+    """
+    if _WORKER_STATE.get('folder') != folder:
+        _WORKER_STATE.clear()
+        input_files, output_files, context = load(os.path.join(folder, 'state'))
+        _WORKER_STATE.update(folder=folder, input_files=input_files,
+                             output_files=output_files, context=context)
+    return _WORKER_STATE
+
+def _open_arrays(state):
+    """
+    Memory-maps the arrays of a call
+    """
+    inputs = []
+    for f in state['input_files']:
+        if isinstance(f, str):
+            inputs.append(np.load(f, mmap_mode='r'))
+        else:
+            fname, dtype, shape, offset, order = f
+            inputs.append(np.memmap(fname, dtype=dtype, mode='r', shape=shape,
+                                    offset=offset, order=order))
+    outputs = [np.load(f, mmap_mode='r+') for f in state['output_files']]
+    return inputs, outputs
+
+def _run_chunk(func, folder, start, stop):
+    state = _worker_state(folder)
+    # the memory maps are opened per block and released with it, so that
+    # the long-lived workers do not keep the files of finished calls
+    # (deleted with their folder) mapped
+    inputs, outputs = _open_arrays(state)
+    blocks = [np.asarray(x[:, start:stop]) for x in inputs]
+    out_blocks, extra = func(state['context'], *blocks)
+    for out, block in zip(outputs, out_blocks):
+        out[start:stop] = np.asarray(block).T
+    return extra
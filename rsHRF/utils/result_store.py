@@ -0,0 +1,169 @@
+"""Storage of the HRF results (hrfa, event_bold, PARA, ...) per run."""
+import json
+import numpy as np
+import scipy.io as sio
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    import zarr
+    # the zarr store is written with the zarr 2 API
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        zarr = None
+except ImportError:
+    zarr = None
+
+FORMATS = ('mat', 'hdf5', 'zarr', 'npz')
+EXTENSIONS = {'mat': '.mat', 'hdf5': '.h5', 'zarr': '.zarr', 'npz': '.npz'}
+
+# voxels per chunk of the (... x nvar) datasets
+VOXEL_CHUNK = 256
+
+def events_to_csr(event_bold):
+    """
+    Ragged per-voxel event indices as a CSR-style pair: the events of
+    voxel j are indices[offsets[j]:offsets[j+1]]
+    """
+    lengths = [np.size(e) for e in event_bold]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    indices = np.zeros(offsets[-1], dtype=np.int64)
+    for j, e in enumerate(event_bold):
+        indices[offsets[j]:offsets[j + 1]] = np.ravel(e)
+    return indices, offsets
+
+def csr_to_events(indices, offsets, voxels=None):
+    """
+    The per-voxel event indices (object array) of the CSR pair
+    """
+    if voxels is None:
+        voxels = range(len(offsets) - 1)
+    events = np.empty(len(voxels), dtype=object)
+    for k, j in enumerate(voxels):
+        events[k] = np.asarray(indices[offsets[j]:offsets[j + 1]])
+    return events
+
+def save_results(fname, dic, output_format='mat'):
+    """
+    Saves the results of a run
+    @fname - output path without extension (EXTENSIONS[output_format] is
+             appended)
+    @dic   - 'para', 'hrfa', 'event_bold', 'PARA' and optionally
+             'event_number', 'data_deconv'
+    'mat' keeps the MATLAB layout (event_bold as a cell array); the other
+    formats store the (... x nvar) arrays compressed, in chunks of voxels
+    (hdf5, zarr), the events as the CSR pair (event_indices,
+    event_offsets) and para as JSON.
+    Returns the path written
+    """
+    if output_format not in FORMATS:
+        raise ValueError('Unknown output format: ' + str(output_format) +
+                         ', choose from ' + ', '.join(FORMATS))
+    path = fname + EXTENSIONS[output_format]
+    if output_format == 'mat':
+        sio.savemat(path, dic)
+        return path
+    arrays, para = _flatten(dic)
+    if output_format == 'npz':
+        np.savez_compressed(path, para=np.array(para), **arrays)
+    elif output_format == 'hdf5':
+        _require(h5py, 'h5py', output_format)
+        with h5py.File(path, 'w') as f:
+            f.attrs['para'] = para
+            for key, value in arrays.items():
+                f.create_dataset(key, data=value, chunks=_chunks(value),
+                                 compression='gzip', shuffle=True)
+    else:
+        _require(zarr, 'zarr', output_format, 'zarr<3')
+        group = zarr.open_group(path, mode='w')
+        group.attrs['para'] = para
+        for key, value in arrays.items():
+            group.create_dataset(key, data=value, chunks=_chunks(value))
+    return path
+
+def load_results(path, voxels=None):
+    """
+    Loads the results saved by save_results
+    @voxels - indices of the voxels to read (default: all), returned in
+              increasing order; with hdf5 and zarr only the chunks
+              holding them are read
+    Returns a dictionary with para, hrfa, event_bold, PARA (and
+    event_number, data_deconv when saved), restricted to the voxels
+    """
+    if voxels is not None:
+        voxels = np.unique(voxels)
+    if path.endswith('.mat'):
+        dic = sio.loadmat(path)
+        events = np.ravel(dic['event_bold'])
+        res = {'para': dic['para']}
+        res['event_bold'] = np.empty(events.size if voxels is None else voxels.size, dtype=object)
+        for k, j in enumerate(range(events.size) if voxels is None else voxels):
+            res['event_bold'][k] = np.ravel(events[j]).astype(int)
+        for key in ('hrfa', 'PARA', 'event_number', 'data_deconv'):
+            if key in dic:
+                res[key] = dic[key] if voxels is None else dic[key][:, voxels]
+        return res
+    if path.endswith('.npz'):
+        store = np.load(path, allow_pickle=False)
+        para = str(store['para'])
+    elif path.endswith('.h5'):
+        _require(h5py, 'h5py', 'hdf5')
+        store = h5py.File(path, 'r')
+        para = store.attrs['para']
+    elif path.endswith('.zarr'):
+        _require(zarr, 'zarr', 'zarr', 'zarr<3')
+        store = zarr.open_group(path, mode='r')
+        para = store.attrs['para']
+    else:
+        raise ValueError('Unknown result file: ' + path)
+    try:
+        res = {'para': json.loads(para)}
+        offsets = np.asarray(store['event_offsets'])
+        indices = store['event_indices']
+        if voxels is None:
+            res['event_bold'] = csr_to_events(np.asarray(indices), offsets)
+        else:
+            res['event_bold'] = csr_to_events(indices, offsets, voxels)
+        for key in ('hrfa', 'PARA', 'event_number', 'data_deconv'):
+            if key in store:
+                res[key] = np.asarray(store[key]) if voxels is None else \
+                           _read_columns(store[key], voxels)
+    finally:
+        if hasattr(store, 'close'):
+            store.close()
+    return res
+
+def _read_columns(dataset, voxels):
+    """
+    Columns of a (chunked) dataset, for increasing voxel indices
+    """
+    if hasattr(dataset, 'oindex'):
+        return np.asarray(dataset.oindex[:, voxels])
+    return np.asarray(dataset[:, list(voxels)])
+
+def _flatten(dic):
+    arrays = {}
+    for key in ('hrfa', 'PARA', 'event_number', 'data_deconv'):
+        if key in dic:
+            arrays[key] = np.atleast_2d(np.asarray(dic[key]))
+    arrays['event_indices'], arrays['event_offsets'] = events_to_csr(dic['event_bold'])
+    para = json.dumps(dic['para'], default=_to_json)
+    return arrays, para
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Cannot store ' + repr(value))
+
+def _chunks(value):
+    if value.ndim == 1:
+        return (min(max(value.shape[0], 1), 65536),)
+    return value.shape[:-1] + (min(max(value.shape[-1], 1), VOXEL_CHUNK),)
+
+def _require(module, name, output_format, requirement=None):
+    if module is None:
+        raise ImportError('The ' + output_format + ' output format requires ' + name +
+                          ' (pip install "' + (requirement or name) + '")')
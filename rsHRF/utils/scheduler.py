@@ -0,0 +1,175 @@
+"""Concurrent execution of independent runs (e.g. the inputs of a BIDS dataset)."""
+import os
+import traceback
+import numpy as np
+import nibabel as nib
+from concurrent.futures import wait, FIRST_COMPLETED
+from joblib import effective_n_jobs
+from joblib.externals.loky import ProcessPoolExecutor
+from joblib.externals.loky.process_executor import BrokenProcessPool
+from . import parallel
+
+# working copies of the (nobs x nmask) signals held by a run: the z-scored
+# and the two band-passed signals, the deconvolved signals and the buffers
+# of the estimation and of the output images
+RUN_COPIES = 6
+
+# environment variables limiting the BLAS/OpenMP threads of a run worker
+THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def split_jobs(n_runs, n_jobs, run_jobs=None):
+    """
+    Splits the worker budget n_jobs (as in joblib, -1: all the cores)
+    between concurrent runs and the voxel workers of each run
+    @run_jobs - runs processed concurrently (default: as many as the
+                budget and the number of runs allow)
+    Returns (run_jobs, voxel_jobs)
+    """
+    total = effective_n_jobs(n_jobs)
+    if run_jobs is None:
+        run_jobs = total
+    run_jobs = int(min(max(run_jobs, 1), max(n_runs, 1), total))
+    return run_jobs, max(total // run_jobs, 1)
+
+def available_memory(meminfo='/proc/meminfo'):
+    """
+    Physical memory currently available (bytes), None when unknown: the
+    MemAvailable estimate of the kernel (free memory and reclaimable page
+    cache), or the free pages where it is not reported
+    """
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def run_memory(input_file, mask_file=None, dtype=np.float64, slab_size=None):
+    """
+    Estimated peak memory (bytes) of demo_rsHRF on a run, from the image
+    headers and the mask: RUN_COPIES copies of the masked signals, plus
+    the 4D image (or one slab of it when streamed)
+    For inputs other than NIfTI images, RUN_COPIES times the file size
+    """
+    img = nib.load(input_file)
+    shape = getattr(img, 'shape', None)
+    if shape is None or len(shape) != 4:
+        return RUN_COPIES * os.path.getsize(input_file)
+    nvox, nobs = int(np.prod(shape[:-1])), shape[-1]
+    nmask = nvox
+    if mask_file is not None:
+        nmask = int(np.count_nonzero(np.asanyarray(nib.load(mask_file).dataobj) > 0))
+    image = nvox if not slab_size else min(int(slab_size), nvox)
+    return int(nobs * (RUN_COPIES * nmask * np.dtype(dtype).itemsize +
+                       image * max(np.dtype(img.get_data_dtype()).itemsize,
+                                   np.dtype(dtype).itemsize)))
+
+def map_runs(func, runs, run_jobs=1, memory=None, max_memory=None,
+             cores_per_run=None, progress=None):
+    """
+    Runs func(*args, **kwargs) for each of the runs, run_jobs at a time
+    @runs     - list of (args, kwargs)
+    @run_jobs - runs processed concurrently, each in a worker process
+                (1: one after the other in this process)
+    @memory   - estimated peak memory (bytes) of each run (see run_memory)
+    @max_memory - bound on the summed memory of the runs in progress; a
+                run is started only when it fits (or when no other run is
+                in progress)
+    @cores_per_run - cores of the voxel workers and BLAS threads of each
+                run worker (see parallel.set_cpu_budget)
+    @progress - called as progress(done, nruns) as the runs complete
+    A failing run does not stop the others: its exception is returned
+    instead (a worker process that dies fails only the runs in progress).
+    Returns the list of the results and the list of (index, message) of
+    the failed runs
+    """
+    nruns = len(runs)
+    results, errors = [None] * nruns, []
+    if memory is None:
+        memory = [0] * nruns
+    if run_jobs <= 1:
+        for i, (args, kwargs) in enumerate(runs):
+            results[i], error = _run_isolated(func, args, kwargs)
+            if error is not None:
+                errors.append((i, error))
+            if progress is not None:
+                progress(i + 1, nruns)
+        return results, errors
+    env = None
+    if cores_per_run is not None:
+        env = dict((var, str(max(int(cores_per_run), 1))) for var in THREAD_VARS)
+    pending, running, used, done = list(range(nruns)), {}, 0, 0
+    executor = ProcessPoolExecutor(max_workers=run_jobs, env=env,
+                                   initializer=parallel.set_cpu_budget,
+                                   initargs=(cores_per_run,))
+    try:
+        while pending or running:
+            for i in _admit(pending, memory, len(running), used, run_jobs, max_memory):
+                pending.remove(i)
+                args, kwargs = runs[i]
+                running[executor.submit(_run_isolated, func, args, kwargs)] = i
+                used += memory[i]
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                i = running.pop(future)
+                used -= memory[i]
+                try:
+                    results[i], error = future.result()
+                except BrokenProcessPool as err:
+                    broken = True
+                    error = 'worker process terminated: ' + str(err)
+                if error is not None:
+                    errors.append((i, error))
+                done += 1
+                if progress is not None:
+                    progress(done, nruns)
+            if broken:
+                # the pool cannot be reused: fail the runs that were in
+                # progress and carry on with a new pool
+                for future, i in running.items():
+                    errors.append((i, 'worker process terminated'))
+                    used -= memory[i]
+                    done += 1
+                    if progress is not None:
+                        progress(done, nruns)
+                running = {}
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=run_jobs, env=env,
+                                               initializer=parallel.set_cpu_budget,
+                                               initargs=(cores_per_run,))
+    finally:
+        executor.shutdown(wait=True)
+    errors.sort()
+    return results, errors
+
+def _admit(pending, memory, nrunning, used, run_jobs, max_memory):
+    """
+    The pending runs to start now, in order: while fewer than run_jobs are
+    in progress, the first runs that fit in max_memory with those in
+    progress (the first pending run always starts when none is)
+    """
+    admitted = []
+    for i in pending:
+        if nrunning + len(admitted) >= run_jobs:
+            break
+        if max_memory is None or used + memory[i] <= max_memory or \
+                (nrunning + len(admitted) == 0):
+            admitted.append(i)
+            used += memory[i]
+    return admitted
+
+def _run_isolated(func, args, kwargs):
+    """
+    Calls func, returning (result, None) or (None, message) when it raises
+    """
+    try:
+        return func(*args, **kwargs), None
+    except Exception as err:
+        return None, ''.join(traceback.format_exception_only(type(err), err)).strip()
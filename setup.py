@@ -45,7 +45,8 @@ setup(
     include_package_data=True,
     zip_safe=False,
     python_requires=">=3.6",
-    install_requires=["numpy", "nibabel", "matplotlib", "scipy", "pybids==0.11.1", "pandas", "patsy", "mpld3", "duecredit", "joblib", "PyWavelets"],
+    install_requires=["numpy", "nibabel", "matplotlib", "scipy", "pybids==0.11.1", "pandas", "patsy", "mpld3", "duecredit", "joblib", "threadpoolctl", "PyWavelets"],
+    extras_require={"hdf5": ["h5py"], "zarr": ["zarr>=2.11,<3"]},
     cmdclass={
         'verify': VerifyVersionCommand,
     },